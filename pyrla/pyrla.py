@@ -25,26 +25,59 @@
 
 import sys
 import re
+import atexit
+import signal
 import threading
 import queue
 import os
 import subprocess
 import shutil
+import shlex
+import tempfile
+import glob
+import hashlib
+import heapq
+import socket
+import socketserver
+import stat
+import asyncio
 import collections
-from time import sleep
+import json
+import decimal
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, monotonic, time as timestamp
 # used to process mathematical expressions
-from math import * #@UnusedWildImport
-import numpy as np #@UnusedImport
-import random #@UnusedImport
+import math
+import random
 
 try:
     import jinja2
     JINJA_AVAILABLE = True
 except ModuleNotFoundError:
     JINJA_AVAILABLE = False
+    
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ModuleNotFoundError:
+    NUMPY_AVAILABLE = False
+    
+# used to reflink files
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
 
 MAX_STATES = 100000
 
+# the names that can be used in mathematical expressions and run conditions
+MATH_NAMESPACE = dict((name, getattr(math, name)) for name in dir(math) if not name.startswith("_"))
+MATH_NAMESPACE["math"] = math
+MATH_NAMESPACE["random"] = random
+if NUMPY_AVAILABLE:
+    MATH_NAMESPACE["np"] = np
+
 # static class
 class Logger():
     debug_level = 0
@@ -64,10 +97,94 @@ class Logger():
         print("%s: %s" % (Logger.messages[level], msg))
         
         
+class Command(object):
+    # characters that have a special meaning for the shell. Quotes are not listed since shlex handles them as the shell does
+    METACHARACTERS = re.compile(r"[|&;<>()$`\\*?\[\]{}~!#\n]")
+    # commands that are (or only make sense as) shell builtins
+    BUILTINS = frozenset(("cd", "export", "source", ".", "exit", "set", "unset", "alias", "eval", "exec", "read", "ulimit", 
+                          "umask", "trap", "shift", "wait", "readonly", "local", "declare", "typeset", "type", "hash"))
+    
+    # returns the list of arguments that can be used to run command without a shell, or None if a shell is required. 
+    # If use_shell is None the choice is made automatically, otherwise it is forced
+    def split(command, use_shell=None):
+        if use_shell or (use_shell is None and Command.METACHARACTERS.search(command) is not None):
+            return None
+        
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            # e.g. unbalanced quotes, the shell will complain about them
+            return None
+        
+        if len(args) == 0:
+            return None
+        # variable assignments (e.g. "FOO=bar command") and builtins are left to the shell
+        if use_shell is None and ("=" in args[0] or args[0] in Command.BUILTINS):
+            return None
+        
+        return args
+    split = staticmethod(split)
+    
+    # works like subprocess.Popen(command, shell=True, **kwargs) but skips the shell whenever possible
+    def popen(command, use_shell=None, **kwargs):
+        args = Command.split(command, use_shell)
+        if args is not None:
+            try:
+                return subprocess.Popen(args, **kwargs)
+            except OSError:
+                # the program can't be found or run: if we are allowed to, we let the shell report the error as usual
+                if use_shell is False:
+                    raise
+        
+        return subprocess.Popen(command, shell=True, **kwargs)
+    popen = staticmethod(popen)
+    
+    # works like popen, but the process is pinned to the given cores (if not None) before it runs any code. Children 
+    # inherit the affinity of the thread that spawns them, hence the affinity of the calling thread is changed while 
+    # the process is spawned, which does not prevent Popen from using vfork/posix_spawn as a preexec_fn would
+    def popen_pinned(command, use_shell, cores, **kwargs):
+        if cores is None:
+            return Command.popen(command, use_shell, **kwargs)
+        
+        affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cores)
+        try:
+            return Command.popen(command, use_shell, **kwargs)
+        finally:
+            os.sched_setaffinity(0, affinity)
+    popen_pinned = staticmethod(popen_pinned)
+    
+    # returns the preexec_fn that pins a process to the given cores, for those cases where the process can't be 
+    # spawned by a thread of its own (see AsyncioEngine)
+    def pinner(cores):
+        if cores is None:
+            return None
+        return lambda: os.sched_setaffinity(0, cores)
+    pinner = staticmethod(pinner)
+    
+    # converts a return code given by Popen to the exit code reported by the shell (128 + n for processes killed by signal n)
+    def exit_code(returncode):
+        return 128 - returncode if returncode < 0 else returncode
+    exit_code = staticmethod(exit_code)
+    
+    # parses the value of the UseShell and NoShell keys
+    def set_shell_mode(key_names, use_shell, inp_parser, option):
+        for k in key_names:
+            if k not in inp_parser or not (k in ("PreExecute", "Execute", "PostExecute") or isinstance(inp_parser[k], BashKey)):
+                Logger.log("The key '%s' listed in %s is neither a bash key nor one of PreExecute, Execute or PostExecute" % (k, option), Logger.WARNING)
+            elif k in ("PreExecute", "Execute", "PostExecute"):
+                Job.use_shell[k] = use_shell
+            else:
+                inp_parser[k].use_shell = use_shell
+    set_shell_mode = staticmethod(set_shell_mode)
+    
+    
 class KeyModifier(object):
-    def __init__(self, modified_key, conditions):
+    def __init__(self, modified_key, conditions, position=0):
         self.modified_key = modified_key
-        self.printed_condition_warnings = []
+        self.raw_conditions = conditions
+        # the order in which the modifier has been defined: if more than one modifier applies, the last one wins
+        self.position = position
         
         self._parse_conditions(conditions)
         
@@ -79,20 +196,6 @@ class KeyModifier(object):
                 Logger.log("A modifier for the key '%s' contains a condition based on itself" % key, Logger.WARNING)
             self.conditions[key] = value
             
-    def applies_to(self, key_value_dict):
-        for cond_key, cond_value in self.conditions.items():
-            if cond_key in key_value_dict:
-                if cond_value != key_value_dict[cond_key]():
-                    return False
-            else:
-                # we do this to avoid printing the same warning more than once
-                if cond_key not in self.printed_condition_warnings:
-                    Logger.log("A modifier for the key '%s' contains the undefined condition key '%s'" % (self.modified_key.key, cond_key), Logger.WARNING)
-                    self.printed_condition_warnings.append(cond_key)
-                    return False
-            
-        return True
-    
     def value(self):
         self.modified_key.expand()
         return self.modified_key()
@@ -102,7 +205,12 @@ class BaseKey(object):
     SPECIAL_KEYS = ("CopyTo", "CopyFrom", "CopyToWrite", "Execute", "DirectoryStructure",
                     "ContemporaryJobs", "Subdirectories", "CopyObjects", "WaitingTime",
                     "Times", "InputSeparator", "Exclusive", "Relaunch", "InputType",
-                    "PreExecute", "PostExecute", "RunConditions")
+                    "PreExecute", "PostExecute", "RunConditions", "BashCache", "BashCacheFile",
+                    "BashNoCache", "BashPrefetch", "LaunchRate", "LaunchBurst", "JinjaUndefined",
+                    "JinjaFilters", "CopyObjectsMode", "CopyThreads", "UseShell", "NoShell",
+                    "BatchSize", "Engine", "HostCores", "HostMemory", "HostSlots", "SchedulerPolicy", "SchedulerWindow", "CpuAffinity",
+                    "MaxLoad", "MinFreeMemory", "MinFreeDisk", "AdmissionInterval", "JournalFile",
+                    "Incremental")
 
     def __init__(self, key, value, key_value_dict):
         self.key = key
@@ -117,47 +225,18 @@ class BaseKey(object):
         # TODO: make it a set
         self.depends_on_keys = []
         self.modifiers = []
+        # modifiers are indexed by the (sorted) names of the keys their conditions are based on and then by the 
+        # values these keys should take, so that finding the modifier that applies to a state is a lookup
+        self.modifier_index = {}
+        # volatile keys may take a different value each time they are expanded, even if the keys they depend on did not change
+        self.volatile = False
 
         self.compute_dependencies()
 
-    def __cmp__(self, other):
-        if other.depends_on(self.key):
-            return - 1
-        elif self.depends_on(other.key):
-            return 1
-        else:
-            ih = self.has_dependencies()
-            oh = other.has_dependencies()
-            if ih and not oh:
-                return 1
-            elif oh and not ih:
-                return -1
-
-            return 0
-
     # returns False if there is no next value
     def set_next_value(self):
         return False
 
-    # this is a recursive function: if A depends on B and B depends on C
-    # then A.depends_on(C) will return True
-    def depends_on(self, key):
-        if key in self.depends_on_keys:
-            return True
-        for k in self.depends_on_keys:
-            if k not in self.key_value_dict:
-                Logger.log("Key '%s' (which is expanded by '%s') is not defined" % (k, self.key), Logger.CRITICAL)
-                exit(1)
-                
-            if self.key_value_dict[k].depends_on(self.key):
-                Logger.log("Circular dependency between '%s' and '%s', aborting" % (self.key, k), Logger.CRITICAL)
-                exit(1)
-                
-            if self.key_value_dict[k].depends_on(key):
-                return True
-
-        return False
-
     def has_dependencies(self):
         return (len(self.depends_on_keys) > 0)
     
@@ -182,21 +261,60 @@ class BaseKey(object):
         return "%s: %s = %s" % (self.__class__.__name__, self.key, self())
     
     def add_modifier(self, modified_key, conditions):
-        new_modifier = KeyModifier(modified_key, conditions)
+        new_modifier = KeyModifier(modified_key, conditions, len(self.modifiers))
         self.modifiers.append(new_modifier)
+        
+        cond_keys = tuple(sorted(new_modifier.conditions.keys()))
+        cond_values = tuple(new_modifier.conditions[k] for k in cond_keys)
+        group = self.modifier_index.setdefault(cond_keys, {})
+        if cond_values in group:
+            Logger.log("The modifier '%s' for the key '%s' has the same conditions as a previous one, which will be ignored" % (conditions, self.key), Logger.WARNING)
+        group[cond_values] = new_modifier
+        
         self.depends_on_keys += list(new_modifier.conditions.keys())
+        # the value of the key also depends on whatever the modifier's value depends on
+        self.depends_on_keys += modified_key.depends_on_keys
+        self.volatile |= modified_key.volatile
         
-    def _expand_modifiers(self):
-        modifiers_applied = 0
-        for m in self.modifiers:
-            if m.applies_to(self.key_value_dict):
-                self.value = m.value()
-                modifiers_applied += 1
+    # warns about modifiers that may apply to the same state. This can happen if two modifiers are based on different 
+    # sets of keys and their conditions agree on the keys they share
+    def check_modifiers(self):
+        groups = list(self.modifier_index.items())
+        num_overlaps = 0
+        example = None
+        for a in range(len(groups)):
+            for b in range(a + 1, len(groups)):
+                keys_a, group_a = groups[a]
+                keys_b, group_b = groups[b]
+                shared_a = [i for i, k in enumerate(keys_a) if k in keys_b]
+                shared_b = [keys_b.index(keys_a[i]) for i in shared_a]
                 
-        if modifiers_applied > 1:
-            Logger.log("Multiple modifiers for key '%s' applied" % (self.key), Logger.WARNING)
+                projected_b = {}
+                for values, m in group_b.items():
+                    projected_b.setdefault(tuple(values[i] for i in shared_b), []).append(m)
+                    
+                for values, m in group_a.items():
+                    overlapping = projected_b.get(tuple(values[i] for i in shared_a), [])
+                    num_overlaps += len(overlapping)
+                    if example is None and len(overlapping) > 0:
+                        example = (m, overlapping[0])
+                        
+        if num_overlaps > 0:
+            Logger.log("%d pairs of modifiers for the key '%s' may apply to the same state (e.g. '%s' and '%s'). In this case the one defined last will be used" 
+                       % (num_overlaps, self.key, example[0].raw_conditions, example[1].raw_conditions), Logger.WARNING)
+        
+    def _expand_modifiers(self):
+        applied = None
+        for cond_keys, group in self.modifier_index.items():
+            m = group.get(tuple(self.key_value_dict[k]() for k in cond_keys))
+            if m is not None and (applied is None or m.position > applied.position):
+                applied = m
                 
-        return modifiers_applied > 0
+        if applied is None:
+            return False
+        
+        self.value = applied.value()
+        return True
     
     def expand_base_value(self):
         self.value = self.raw_value
@@ -250,42 +368,139 @@ class FileKey(MultipleKey):
 
 
 class ExpressionKey(BaseKey):
+    VARIABLE_RE = r'(\$\([\w\[\]]+\))'
+    MATH_RE = r'(\$\{.*?\})'
+    # the maximum number of compiled expressions cached by each mathematical expression. Variables are substituted 
+    # as text (their values can be any piece of python code), hence each state may yield a different expression 
+    # and the cache should not grow with the number of states
+    CODE_CACHE_SIZE = 256
+    
     def __init__(self, key, value, key_value_dict):
         BaseKey.__init__(self, key, value, key_value_dict)
+        self.compile()
+        # mathematical expressions that draw random numbers should be re-evaluated for each state
+        self.volatile = any(re.search(r'\brandom\b', source) != None for source, _, _ in self.math_expressions)
+        
+    def _split_variables(text):
+        # odd items are the names of the variables, even items are the text found between them
+        tokens = re.split(ExpressionKey.VARIABLE_RE, text)
+        for i in range(1, len(tokens), 2):
+            # we get rid of $( and )
+            tokens[i] = tokens[i][2:-1]
+        return tokens
+    _split_variables = staticmethod(_split_variables)
+    
+    # split the raw value once and for all, so that expanding it boils down to a join. Odd items of 
+    # self.template are indexes into self.math_expressions, even items are lists of tokens
+    # as returned by _split_variables
+    def compile(self):
+        self.template = []
+        self.math_expressions = []
+        for i, token in enumerate(re.split(ExpressionKey.MATH_RE, self.raw_value)):
+            if i % 2 == 0:
+                self.template.append(ExpressionKey._split_variables(token))
+            else:
+                # we have to get rid of ${ and }. The last item caches the code objects of the most recent expressions 
+                # obtained by expanding the variables
+                self.math_expressions.append((token[2:-1], ExpressionKey._split_variables(token[2:-1]), collections.OrderedDict()))
+                self.template.append(len(self.math_expressions) - 1)
 
-    def expand_variables(self):
+    def expand_variables(self, tokens):
         # expand the variables found by compute_dependencies
-        for key in self.depends_on_keys:
+        if len(tokens) == 1:
+            return tokens[0]
+        
+        expanded = list(tokens)
+        for i in range(1, len(tokens), 2):
+            key = tokens[i]
             try:
-                dep_value = self.key_value_dict[key]()
-                self.value = self.value.replace("$(%s)" % key, dep_value)
+                expanded[i] = self.key_value_dict[key]() + ""
             except Exception as e:
+                expanded[i] = "$(%s)" % key
                 Logger.log("Can't expand variable '%s' in line '%s' (error: %s)" % (key, self.raw_value, e), Logger.WARNING)
+                
+        return "".join(expanded)
 
-    def expand_math(self):
-        # expand mathematical expressions
-        math_expressions = re.findall('\$\{.*?\}' , self.value)
-
-        for mk in math_expressions:
-            try:
-                # we have to get rid of ${ and }
-                res = eval(mk[2:-1])
-                self.value = self.value.replace(mk, str(res))
-            except Exception as e:
-                Logger.log("Can't expand mathematical expression '%s' in line '%s' (error: %s)" % (mk, self.raw_value, e), Logger.WARNING)
+    def expand_math(self, index):
+        source, tokens, code_cache = self.math_expressions[index]
+        expression = self.expand_variables(tokens)
+        try:
+            code = code_cache.get(expression)
+            if code is None:
+                code = compile(expression.strip(), "<%s>" % self.key, "eval")
+                code_cache[expression] = code
+                if len(code_cache) > ExpressionKey.CODE_CACHE_SIZE:
+                    code_cache.popitem(last=False)
+            else:
+                code_cache.move_to_end(expression)
+            return str(eval(code, MATH_NAMESPACE))
+        except Exception as e:
+            Logger.log("Can't expand mathematical expression '${%s}' in line '%s' (error: %s)" % (expression, self.raw_value, e), Logger.WARNING)
+            return "${%s}" % expression
 
     def expand_base_value(self):
-        self.value = self.raw_value
-        self.expand_variables()
-        self.expand_math()
+        self.value = "".join(self.expand_math(item) if i % 2 else self.expand_variables(item) for i, item in enumerate(self.template))
         
 
 class BashKey(ExpressionKey):
     RE = '^\$b\{.*?\}$'
     
+    # maps each command to its (output, return code) pair. The cache is shared by all the BashKeys
+    cache = {}
+    cache_enabled = True
+    cache_lock = threading.Lock()
+    # if not None, commands are not run but stored here so that they can be run later (see prefetch)
+    collected_commands = None
+    
     def __init__(self, key, value, key_value_dict):
         ExpressionKey.__init__(self, key, value, key_value_dict)
+        # set by the StateFactory for those keys whose commands can be known before any other command is run
+        self.prefetchable = False
+        # None means that the shell is used only if the command requires it (see Command)
+        self.use_shell = None
+        
+    def run_command(command, use_shell=None):
+        # the universal_newlines=True makes Popen use str instead of bytes (among other side effects)
+        try:
+            p = Command.popen(command, use_shell, stdout=subprocess.PIPE, universal_newlines=True)
+        except OSError as e:
+            Logger.log("Can't run the bash command '%s' (error: %s)" % (command, e), Logger.WARNING)
+            return "", 127
+        out = p.communicate()[0]
+        
+        return out.strip(), p.returncode
+    run_command = staticmethod(run_command)
+    
+    def prefetch(commands, max_workers):
+        # commands maps each command to its use_shell value
+        commands = dict((c, use_shell) for c, use_shell in commands.items() if c not in BashKey.cache)
+        Logger.log("Running %d bash commands using %d parallel workers" % (len(commands), max_workers), Logger.INFO)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for command, result in zip(commands, executor.map(BashKey.run_command, commands, commands.values())):
+                with BashKey.cache_lock:
+                    BashKey.cache[command] = result
+    prefetch = staticmethod(prefetch)
+    
+    def load_cache(filename):
+        if not os.path.isfile(filename):
+            return
+        
+        try:
+            with open(filename) as f:
+                BashKey.cache.update((command, tuple(result)) for command, result in json.load(f).items())
+        except ValueError as e:
+            Logger.log("Can't load the bash cache file '%s' (error: %s), I will ignore it" % (filename, e), Logger.WARNING)
+    load_cache = staticmethod(load_cache)
+    
+    def save_cache(filename):
+        # commands that failed are not stored, so that they will be run again the next time
+        with BashKey.cache_lock:
+            to_save = dict((command, result) for command, result in BashKey.cache.items() if result[1] == 0)
         
+        with open(filename, "w") as f:
+            json.dump(to_save, f, indent=1)
+    save_cache = staticmethod(save_cache)
+    
     def expand_base_value(self):
         ExpressionKey.expand_base_value(self)
         found_keys = re.findall(BashKey.RE , self.value)
@@ -293,13 +508,25 @@ class BashKey(ExpressionKey):
             Logger.log("Can't expand key '%s' in line '%s' (error: bash commands should be enclosed between '$b{' and '}')" % (self.key, self.raw_value), Logger.WARNING)
         else:
             command = found_keys[0][3:-1]
-            # the universal_newlines=True makes Popen use str instead of bytes (among other side effects)
-            p = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, universal_newlines=True)
-            out = p.communicate()[0]
-            self.value = out.strip()
+            use_cache = BashKey.cache_enabled and not self.volatile
+            
+            if BashKey.collected_commands is not None and self.prefetchable:
+                if use_cache:
+                    BashKey.collected_commands[command] = self.use_shell
+                self.value = ""
+                return
+            
+            if use_cache and command in BashKey.cache:
+                self.value = BashKey.cache[command][0]
+                return
+            
+            self.value, returncode = BashKey.run_command(command, self.use_shell)
+            if use_cache:
+                with BashKey.cache_lock:
+                    BashKey.cache[command] = (self.value, returncode)
             
-            if p.returncode != 0:
-                Logger.log("The bash command '%s' associated to the key '%s' returned %d (!= 0)" % (command, self.key, p.returncode), Logger.WARNING)
+            if returncode != 0:
+                Logger.log("The bash command '%s' associated to the key '%s' returned %d (!= 0)" % (command, self.key, returncode), Logger.WARNING)
 
 
 class ExpressionMultipleKey(MultipleKey, ExpressionKey):
@@ -309,17 +536,94 @@ class ExpressionMultipleKey(MultipleKey, ExpressionKey):
         MultipleKey.__init__(self, key, value, key_value_dict)
         ExpressionKey.__init__(self, key, value, key_value_dict)
 
+    STEP_RE = r"^([+\-*/])\s*([0-9]*\.?[0-9]+(?:[eE][+\-]?[0-9]+)?)$"
+
+    def _value_to_str(v):
+        # this is a (dirty) way to understand if v is (or the user wants it to be) an integer or not
+        if math.fabs(v - round(v)) < 1e-6:
+            return str(int(round(v)))
+        return str(v)
+    _value_to_str = staticmethod(_value_to_str)
+    
+    def _check_size(self, size):
+        if size > MAX_STATES:
+            Logger.log("Too many values generated by the complex math expression '%s'" % self.raw_value, Logger.CRITICAL)
+            exit(1)
+            
+    def _wrong_direction(self):
+        Logger.log("The 'Via' parameter in the complex math expression '%s' is pointing in the wrong direction" % self.raw_value, Logger.CRITICAL)
+        exit(1)
+    
+    # additive and multiplicative steps are generated directly, without accumulating floating-point errors. 
+    # Returns None if the sequence is not of either type
+    def _fast_sequence(self, start, target, step):
+        step_found = re.findall(ExpressionMultipleKey.STEP_RE, step)
+        if len(step_found) != 1:
+            return None
+        
+        try:
+            d_start = decimal.Decimal(start)
+            d_target = decimal.Decimal(target)
+            op, d_step = step_found[0][0], decimal.Decimal(step_found[0][1])
+        except decimal.InvalidOperation:
+            return None
+        # infinities and NaNs are left to the step-by-step evaluation
+        if not d_start.is_finite() or not d_target.is_finite():
+            return None
+        
+        if op in "+-":
+            if op == "-":
+                d_step = -d_step
+            diff = d_target - d_start
+            # the sequence contains start only, whatever the step
+            if diff == 0:
+                return [float(d_start)]
+            if d_step <= 0 and diff >= 0 or d_step >= 0 and diff < 0:
+                self._wrong_direction()
+            # the number of values that come before target (which is excluded), computed exactly
+            size = max(1, int((diff / d_step).to_integral_value(rounding=decimal.ROUND_CEILING)))
+            self._check_size(size)
+            
+            # values are rounded to the number of decimal digits of start and step, which is where the exact sequence lives
+            digits = max(0, -d_start.as_tuple().exponent, -d_step.as_tuple().exponent)
+            if NUMPY_AVAILABLE:
+                return np.round(float(d_start) + np.arange(size) * float(d_step), digits).tolist()
+            return [round(float(d_start) + i * float(d_step), digits) for i in range(size)]
+        else:
+            # geometric sequences are short, so here we can afford to compute each value exactly
+            if d_start <= 0 or d_target <= 0 or d_step <= 0 or d_step == 1:
+                return None
+            factor = d_step if op == "*" else 1 / d_step
+            if d_start == d_target:
+                return [float(d_start)]
+            if (d_start < d_target) != (factor > 1):
+                self._wrong_direction()
+                
+            ascending = d_start < d_target
+            values = []
+            next_v = d_start
+            while (next_v < d_target) if ascending else (next_v > d_target):
+                values.append(float(next_v))
+                self._check_size(len(values))
+                next_v = next_v * d_step if op == "*" else next_v / d_step
+            return values
+        
     def expand_complex_math(self):
         compl_found = re.findall(ExpressionMultipleKey.RE, self.value)[0]
 
         if len(compl_found) != 3:
             Logger.log("Can't expand complex mathematical expression in line '%s' (error: malformed line)" % (self.raw_value), Logger.CRITICAL)
             exit(1)
+            
+        values = self._fast_sequence(*[x.strip() for x in compl_found])
+        if values is not None:
+            self.value = [ExpressionMultipleKey._value_to_str(v) for v in values]
+            return
 
         self.value = []
         next_v = float(compl_found[0])
         target = float(compl_found[1])
-        old_dist = fabs(next_v - target)
+        old_dist = math.fabs(next_v - target)
         if next_v <= target:
             condition = lambda test, tar: test < tar
         else:
@@ -328,24 +632,21 @@ class ExpressionMultipleKey(MultipleKey, ExpressionKey):
         end = False
         while not end:
             # this is a (dirty) way to understand if next_v is (or the user wants it to be) an integer or not
-            if fabs(next_v - round(next_v)) < 1e-6:
+            if math.fabs(next_v - round(next_v)) < 1e-6:
                 next_v = int(round(next_v))
             self.value.append(str(next_v))
-            if len(self.value) > MAX_STATES:
-                Logger.log("Too many values generated by the complex math expression '%s'" % self.raw_value, Logger.CRITICAL)
-                exit(1)
+            self._check_size(len(self.value))
             try:
-                next_v = eval(str(next_v) + compl_found[2])
+                next_v = eval(str(next_v) + compl_found[2], MATH_NAMESPACE)
             except Exception as e:
                 Logger.log("Can't expand complex math expression in line '%s' (error: %s)" % (self.raw_value, e), Logger.CRITICAL)
                 exit(1)
 
-            new_dist = fabs(next_v - target)
+            new_dist = math.fabs(next_v - target)
             if not condition(next_v, target):
                 end = True
             elif new_dist > old_dist:
-                Logger.log("The 'Via' parameter in the complex math expression '%s' is pointing in the wrong direction" % self.raw_value, Logger.CRITICAL)
-                exit(1)
+                self._wrong_direction()
             old_dist = new_dist
 
 
@@ -390,7 +691,7 @@ class KeyFactory(object):
 
 class KeyValueDict(collections.UserDict):
     REQUIRED_BASEKEYS = ("CopyFrom", "ContemporaryJobs")
-    PROTECTED_KEYS = ("JOB_ID", "BASE_DIR")
+    PROTECTED_KEYS = ("JOB_ID", "BASE_DIR", "JOB_CORES")
     ACCEPTED_INPUT_TYPES = ("OptionList", "LAMMPS", "Jinja2")
 
     def __init__(self, input_file):
@@ -400,6 +701,9 @@ class KeyValueDict(collections.UserDict):
         
         self["JOB_ID"] = KeyFactory.get_key("JOB_ID", "-1", self)
         self["BASE_DIR"] = KeyFactory.get_key("BASE_DIR", os.getcwd(), self)
+        # the cores assigned to a job are known only when the job is started (see Job.expand_cores)
+        self["JOB_CORES"] = BaseKey("JOB_CORES", Job.CORES_PLACEHOLDER, self)
+        self["JOB_CORES"].depends_on_keys = []
         
         self.modifiers = []
         
@@ -419,7 +723,7 @@ class KeyValueDict(collections.UserDict):
         else:
             self["InputType"] = KeyFactory.get_key("InputType", "OptionList", self)
             
-        if self["InputType"] == "Jinja2" and not JINJA_AVAILABLE:
+        if self["InputType"]() == "Jinja2" and not JINJA_AVAILABLE:
             Logger.log("The jinja2 python package required by InputType = \"Jinja2\" was not found, aborting", Logger.CRITICAL)
             exit(1)
 
@@ -443,6 +747,9 @@ class KeyValueDict(collections.UserDict):
         for mod in self.modifiers:
             if mod.key not in self:
                 Logger.log("There is a modifier associated to the undefined key '%s'" % mod.key, Logger.WARNING)
+                
+        for key in self.values():
+            key.check_modifiers()
 
     def parse(self):
         with open(self.input) as f:
@@ -486,8 +793,118 @@ class KeyValueDict(collections.UserDict):
                 self[key] = KeyFactory.get_key(key, value, self)
 
 
+# the CopyFrom file of OptionList and LAMMPS inputs, parsed once and for all. For each list of keys to be overwritten 
+# we store a plan made of the chunks of unchanged text that lie between the lines to be overwritten
+class CopyFromIndex(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.positions = {}
+        self.plans = {}
+        self.lock = threading.Lock()
+        
+    # maps each key to the first line where it is defined
+    def _index(self, input_type, sep):
+        positions = {}
+        for i, line in enumerate(self.lines):
+            sline = line.split()
+            if input_type == "OptionList" and len(sline) > 1 and sline[1] == sep:
+                positions.setdefault(sline[0], i)
+            elif input_type == "LAMMPS" and len(sline) > 2 and sline[0] == "variable":
+                positions.setdefault(sline[1], i)
+                
+        return positions
+    
+    # returns the chunks of unchanged text, the keys whose lines should be written between consecutive chunks and the 
+    # keys that are not defined in the file
+    def get_plan(self, input_type, sep, keys):
+        plan_key = (input_type, sep, tuple(keys))
+        with self.lock:
+            if plan_key not in self.plans:
+                if (input_type, sep) not in self.positions:
+                    self.positions[(input_type, sep)] = self._index(input_type, sep)
+                positions = self.positions[(input_type, sep)]
+                
+                overwritten = sorted((positions[k], k) for k in keys if k in positions)
+                chunks = []
+                last = 0
+                for pos, _ in overwritten:
+                    chunks.append("".join(self.lines[last:pos]))
+                    last = pos + 1
+                chunks.append("".join(self.lines[last:]))
+                missing = [k for k in keys if k not in positions]
+                
+                self.plans[plan_key] = (chunks, [k for _, k in overwritten], missing)
+            
+            return self.plans[plan_key]
+
+
+# CopyObjects can be copied, hard-linked, symlinked or reflinked (i.e. copied-on-write). Hard links and reflinks
+# fall back to a copy if the filesystem does not support them
+class ObjectCopier(object):
+    MODES = ("Copy", "Hardlink", "Symlink", "Reflink")
+    # the ioctl request used by Linux to clone a file (see ioctl_ficlone(2))
+    FICLONE = 0x40049409
+    # if not None, the files contained in directories are copied by this pool, which is shared by all the jobs
+    executor = None
+    
+    def _reflink(src, dst):
+        if fcntl is None:
+            raise OSError("reflinks are not supported on this platform")
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), ObjectCopier.FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+    _reflink = staticmethod(_reflink)
+    
+    def copy_file(mode, src, dst):
+        link = {"Hardlink" : os.link, "Reflink" : ObjectCopier._reflink}.get(mode)
+        if link is not None:
+            try:
+                link(src, dst)
+                return dst
+            except OSError:
+                # e.g. src and dst are on different filesystems
+                pass
+        
+        shutil.copy2(src, dst)
+        return dst
+    copy_file = staticmethod(copy_file)
+    
+    # copy src (a file or a directory) into the dst_dir directory
+    def copy(mode, src, dst_dir):
+        dst = os.path.join(dst_dir, os.path.basename(os.path.normpath(src)))
+        if mode == "Symlink":
+            if os.path.islink(dst) or os.path.isfile(dst):
+                os.remove(dst)
+            os.symlink(src, dst)
+        elif os.path.isdir(src):
+            # the dst in copytree may not exist so we have to give it the current dir + the name
+            # of the folder we want to copy
+            if mode == "Copy" and ObjectCopier.executor is None:
+                shutil.copytree(src, dst)
+                return
+            
+            futures = []
+            def copy_function(s, d):
+                if ObjectCopier.executor is None:
+                    ObjectCopier.copy_file(mode, s, d)
+                else:
+                    futures.append(ObjectCopier.executor.submit(ObjectCopier.copy_file, mode, s, d))
+                return d
+            
+            shutil.copytree(src, dst, copy_function=copy_function)
+            for f in futures:
+                f.result()
+        elif mode == "Copy":
+            shutil.copy(src, dst_dir)
+        else:
+            if os.path.isfile(dst):
+                os.remove(dst)
+            ObjectCopier.copy_file(mode, src, dst)
+    copy = staticmethod(copy)
+
+
 # our worker!
-class Job(threading.Thread):
+class Job(object):
 
     class SafeError(Exception):
         def __init__(self, value):
@@ -495,26 +912,52 @@ class Job(threading.Thread):
         def __str__(self):
             return self.value
 
-    queue = queue.Queue(1)
-    dir_lock = threading.Lock()
     dir_taken = {}
     dir_taken_lock = threading.Lock()
-    # contains the lines taken from the original copy_from file
-    copy_from_lines = None
+    # the CopyFromIndex built from the lines of the original copy_from file
+    copy_from_index = None
+    # the compiled jinja2 template, shared by all the jobs
+    copy_from_template = None
+    # maps the JOB_IDs of the jobs that have been staged in advance to their working directories (or to None if 
+    # staging failed)
+    staged = {}
+    # maps PreExecute, Execute and PostExecute to True (always use a shell) or False (never use a shell). Commands 
+    # associated to keys that are not in the dictionary use a shell only if they need one
+    use_shell = {}
+    # if not None, the CorePool that assigns the cores to the running jobs
+    core_pool = None
+    # the status files of the batches that are running (see _run_batch), which are removed at exit if pyrla is stopped
+    status_files = set()
+    # if not None, the AdmissionControl that delays the start of the jobs when the host is too busy
+    admission = None
+    # if not None, the Journal where the life cycle of each job is recorded
+    journal = None
+    # if True, jobs that already completed successfully with the same fingerprint are not run again
+    incremental = False
+    # successful jobs leave a file named MARKER_FILE, which contains their fingerprint, in their working directory
+    MARKER_FILE = ".pyrla_done"
+    # jobs staged by --prepare-only leave a file named STAGED_PREFIX + JOB_ID, which contains the hash of their state, 
+    # in their working directory, so that a later run does not stage them again
+    STAGED_PREFIX = ".pyrla_staged_"
+    CORES_PLACEHOLDER = "$(JOB_CORES)"
 
     def __init__(self, tid, safe):
-        threading.Thread.__init__(self)
         self.tid = tid
+        # the cores the job is pinned to, if any
+        self.cores = None
+        # the fingerprint of the current state (only computed if incremental is True)
+        self.fingerprint = None
+        # where the life cycle of the jobs is recorded (see Journal and MemoryJournal)
+        self.journal = Job.journal
         self.original_dir = os.getcwd()
         self.working_dir = os.getcwd()
         self.safe = safe
 
-    def create_copy_to(self):
+    # contents is the CopyTo file as returned by render_copy_to, if it has already been rendered
+    def create_copy_to(self, contents=None):
         if "CopyFrom" not in self.state:
             return
 
-        sep = self.state["InputSeparator"] if "InputSeparator" in self.state else "="
-
         if "CopyTo" in self.state:
             name = self.state['CopyTo']
         else:
@@ -522,60 +965,73 @@ class Job(threading.Thread):
                 raise Job.SafeError("Job %d: I refuse to overwrite the CopyFrom file '%s', you should either use CopyTo to write to a different filename or DirectoryStructure to set a different target directory" % (self.tid, self.state['CopyFrom']))
             else:
                 name = self.state['CopyFrom']
+                
+        if contents is None:
+            contents = self.render_copy_to()
 
-        # with list(set(*)) we are sure that copy_list contains only unique elements
-        if "CopyToWrite" in self.state:
-            copy_list = list(set(self.state['CopyToWrite'].split()))
-        else:
-            copy_list = []
+        out = os.path.join(self.working_dir, name)
+        if self.safe and os.path.exists(out):
+            raise Job.SafeError("Job %d: can't overwrite file '%s' in safe mode, aborting job" % (self.tid, out))
+        
+        # the file is first written to a temporary file which is then renamed, so that out is never found half-written
+        tmp_out = "%s.%d.%d.tmp" % (out, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_out, "w") as f:
+                f.write(contents)
+            os.replace(tmp_out, out)
+        except BaseException:
+            if os.path.exists(tmp_out):
+                os.remove(tmp_out)
+            raise
+        
+    # returns the contents of the CopyTo file of the current state, or None if the state has no CopyFrom
+    def render_copy_to(self):
+        if "CopyFrom" not in self.state:
+            return None
+        
+        sep = self.state["InputSeparator"] if "InputSeparator" in self.state else "="
 
+        # copy_list contains only unique elements, in the order they appear in CopyToWrite
+        copy_list = []
         copy_not_found = []
-        for k in copy_list:
-            if k not in self.state:
-                copy_list.remove(k)
-                copy_not_found.append(k)
+        if "CopyToWrite" in self.state:
+            for k in self.state['CopyToWrite'].split():
+                if k not in self.state:
+                    if k not in copy_not_found:
+                        copy_not_found.append(k)
+                elif k not in copy_list:
+                    copy_list.append(k)
 
         if len(copy_not_found) != 0:
             Logger.log("Job %d: keys '%s' are in CopyToWrite but are not defined" % (self.tid, " ".join(copy_not_found)), Logger.WARNING)
 
-        out = os.path.join(self.working_dir, name)
-        if self.safe and os.path.exists(out):
-            raise Job.SafeError("Job %d: can't overwrite file '%s' in safe mode, aborting job" % (self.tid, out))
-        
-        with open(out, "w") as f:
+        if self.state["InputType"] in ("OptionList", "LAMMPS"):
             if self.state["InputType"] == "OptionList":
-                for line in Job.copy_from_lines:
-                    sline = line.split()
-                    if len(sline) > 1 and sline[0] in copy_list and sline[1] == sep:
-                        f.write("%s %s %s\n" % (sline[0], sep, self.state[sline[0]]))
-                        copy_list.remove(sline[0])
-                        Logger.log("Job %d: overwriting %s" % (self.tid, sline[0]), Logger.DEBUG)
-                    else:
-                        f.write(line)
-    
-                for k in copy_list:
-                    f.write("%s %s %s\n" % (k, sep, self.state[k]))
-            elif self.state["InputType"] == "LAMMPS":
-                for line in Job.copy_from_lines:
-                    sline = line.split()
-                    if len(sline) > 2 and sline[0] == "variable" and sline[1] in copy_list:
-                        f.write("variable %s equal %s\n" % (sline[1], self.state[sline[1]]))
-                        copy_list.remove(sline[1])
-                        Logger.log("Job %d: overwriting %s" % (self.tid, sline[1]), Logger.DEBUG)
-                    else:
-                        f.write(line)
-                        
-                if len(copy_list) != 0:
-                    Logger.log("Job %d: keys '%s' have not been found in the original input file and hence have not been used" % (self.tid, " ".join(copy_list)), Logger.WARNING)
-            elif self.state["InputType"] == "Jinja2":
-                j_env = jinja2.Environment()
-                try:
-                    j_template = j_env.from_string("".join(Job.copy_from_lines))
-                except jinja2.exceptions.TemplateError as e:
-                    Logger.log("Job %d: jinja2 raised the following error: '%s'" % e.message, Logger.CRITICAL)
-                    exit(1)
-                key_dict = dict((key, self.state[key]) for key in copy_list)
-                f.write(j_template.render(key_dict))
+                line_format = "%s " + sep.replace("%", "%%") + " %s\n"
+            else:
+                line_format = "variable %s equal %s\n"
+                
+            chunks, overwritten, missing = Job.copy_from_index.get_plan(self.state["InputType"], sep, copy_list)
+            parts = [chunks[0]]
+            for k, chunk in zip(overwritten, chunks[1:]):
+                parts.append(line_format % (k, self.state[k]))
+                parts.append(chunk)
+                Logger.log("Job %d: overwriting %s" % (self.tid, k), Logger.DEBUG)
+            
+            if self.state["InputType"] == "OptionList":
+                parts.extend(line_format % (k, self.state[k]) for k in missing)
+            elif len(missing) != 0:
+                Logger.log("Job %d: keys '%s' have not been found in the original input file and hence have not been used" % (self.tid, " ".join(missing)), Logger.WARNING)
+                
+            return "".join(parts)
+        elif self.state["InputType"] == "Jinja2":
+            key_dict = dict((key, self.state[key]) for key in copy_list)
+            try:
+                return Job.copy_from_template.render(key_dict)
+            except jinja2.exceptions.TemplateError as e:
+                raise Job.SafeError("Job %d: jinja2 raised the following error: '%s', aborting job" % (self.tid, e))
+        
+        return ""
                     
 
     # also set self.working_dir
@@ -600,156 +1056,1391 @@ class Job(threading.Thread):
             return
 
         objs = self.state['CopyObjects'].split()
-
-        for obj in objs:
+        
+        # either a single mode for all the objects or one mode per object
+        modes = [m.capitalize() for m in self.state['CopyObjectsMode'].split()] if "CopyObjectsMode" in self.state else ["Copy"]
+        if len(modes) == 1:
+            modes = modes * len(objs)
+        elif len(modes) != len(objs):
+            Logger.log("Job %d: CopyObjectsMode should contain either one mode or one mode per object, all the objects will be copied" % self.tid, Logger.WARNING)
+            modes = ["Copy"] * len(objs)
+
+        for obj, mode in zip(objs, modes):
+            if mode not in ObjectCopier.MODES:
+                Logger.log("Job %d: invalid CopyObjectsMode '%s' for '%s', the object will be copied. The supported values are %s" % (self.tid, mode, obj, ", ".join(ObjectCopier.MODES)), Logger.WARNING)
+                mode = "Copy"
+                
             # this one-liner should be enough to discriminate between relative and absolute paths
             obj = os.path.join(self.original_dir, obj)
             try:
-                if os.path.isdir(obj):
-                    # the dst in copytree may not exist so we have to give it the current dir + the name
-                    # of the folder we want to copy
-                    name = os.path.basename(os.path.normpath(obj))
-                    shutil.copytree(obj, os.path.join(self.working_dir, name))
-                else:
-                    shutil.copy(obj, self.working_dir)
+                ObjectCopier.copy(mode, obj, self.working_dir)
             except Exception as e:
                 Logger.log("Job %d: caught an error while trying to copy '%s': %s" % (self.tid, obj, e), Logger.WARNING)
 
+    # returns the paths of the files contained in path (or path itself, if it is a file), sorted
+    def _walk(path):
+        if not os.path.isdir(path):
+            return [path]
+        
+        paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths.extend(os.path.join(root, f) for f in sorted(files))
+        return paths
+    _walk = staticmethod(_walk)
+
+    # a hash of everything that determines the outcome of the current state: the values of its keys (and hence its 
+    # commands), the contents of its CopyTo file (as returned by render_copy_to) and the size and modification time 
+    # of the sources of its CopyObjects. Nothing needs to be staged to compute it
+    def compute_fingerprint(self, copy_to_contents):
+        h = Job.state_hasher(self.state, ("JOB_ID",))
+        
+        if copy_to_contents is not None:
+            h.update(copy_to_contents.encode())
+            
+        if "CopyObjects" in self.state:
+            for obj in self.state["CopyObjects"].split():
+                for path in Job._walk(os.path.join(self.original_dir, obj)):
+                    try:
+                        st = os.stat(path)
+                        h.update(("%s %d %d" % (path, st.st_size, st.st_mtime_ns)).encode())
+                    except OSError:
+                        h.update(("%s missing" % path).encode())
+                        
+        return h.hexdigest()
+    
+    def _mark_done(self, working_dir, fingerprint):
+        if fingerprint is not None:
+            with open(os.path.join(working_dir, Job.MARKER_FILE), "w") as f:
+                f.write("%s %f\n" % (fingerprint, timestamp()))
+                
+    # the contents of the working directory are about to change, so the marker left by a previous run (if any) does 
+    # not hold anymore, even if this run fails
+    def _clear_done(self):
+        try:
+            os.remove(os.path.join(self.working_dir, Job.MARKER_FILE))
+        except FileNotFoundError:
+            pass
+
+    # creates the working directory, the CopyTo file and the CopyObjects of the current state
+    def stage(self, copy_to_contents=None):
+        self.working_dir = self.original_dir
+        self.create_dir_structure()
+        self._clear_done()
+        self.create_copy_to(copy_to_contents)
+        self.copy_objects()
+        
+    # the working directory of the current state, which may not have been created yet
+    def target_dir(self):
+        if "DirectoryStructure" in self.state:
+            return os.path.join(self.original_dir, self.state['DirectoryStructure'])
+        return self.original_dir
+
     def is_directory_used(self):
         if self.relative_dir in Job.dir_taken:
             return Job.dir_taken[self.relative_dir]
         else:
             return False
 
-    def _execute(self, cmd):
-        # we need a lock because we have to change the current directory
-        Job.dir_lock.acquire()
+    # returns the command associated to key as a (command, use_shell, working directory, cores) tuple
+    def _command(self, key):
+        return self.expand_cores(self.state[key]), Job.use_shell.get(key), self.working_dir, self.cores
+    
+    # replaces $(JOB_CORES) with the list of cores assigned to the job or, if jobs are not pinned, with the list of 
+    # the cores available to pyrla
+    def expand_cores(self, command):
+        if Job.CORES_PLACEHOLDER not in command:
+            return command
+        cores = self.cores if self.cores is not None else Host.cores()
+        return command.replace(Job.CORES_PLACEHOLDER, ",".join(str(c) for c in cores))
+    
+    # returns a sha1 object fed with the values of the keys of a state, except those in exclude and JOB_CORES (which 
+    # depends on where the job runs)
+    def state_hasher(state, exclude=()):
+        items = sorted((k, v) for k, v in state.items() if k != "JOB_CORES" and k not in exclude)
+        return hashlib.sha1(json.dumps(items).encode())
+    state_hasher = staticmethod(state_hasher)
+    
+    # a hash of the values of the keys of a state, used to check that a JOB_ID refers to the same state across runs
+    def state_hash(state):
+        return Job.state_hasher(state).hexdigest()
+    state_hash = staticmethod(state_hash)
+    
+    def _record(self, state, event, **fields):
+        if self.journal is not None:
+            record = {"event" : event, "job_id" : int(state["JOB_ID"]), "hash" : Job.state_hash(state)}
+            record.update(fields)
+            self.journal.write(record)
+            
+    # runs the command associated to key and records its exit code
+    def _phase(self, key):
+        start = monotonic()
+        exit_code = yield self._command(key)
+        self._record(self.state, "phase", phase=key, exit_code=exit_code, duration=round(monotonic() - start, 3))
+        return exit_code
+    
+    # the number of cores a batch should be pinned to
+    def cores_needed(batch):
+        needed = 1
+        for state in batch:
+            if "JobCores" in state:
+                try:
+                    needed = max(needed, int(math.ceil(float(state["JobCores"]))))
+                except ValueError:
+                    pass
+        return needed
+    cores_needed = staticmethod(cores_needed)
+
+    # sets the current state and prepares its working directory. Returns True if the state can be run. The 
+    # Exclusive directories acquired by the job are added to held_dirs
+    def _prepare(self, state, held_dirs):
+        self.state = state
+        if "DirectoryStructure" in self.state:
+            self.relative_dir = self.state['DirectoryStructure']
+        else:
+            self.relative_dir = "."
+
+        # states of the same batch run one after the other, and hence they can share an Exclusive directory
+        if self.state["Exclusive"] == "True" and self.relative_dir not in held_dirs:
+            with self.dir_taken_lock:
+                if self.is_directory_used():
+                    return False
+                Job.dir_taken[self.relative_dir] = True
+            held_dirs.add(self.relative_dir)
+
+        self.fingerprint = None
+        try:
+            # up-to-date states are detected before anything is staged, so that their files are left alone
+            copy_to_contents = None
+            if Job.incremental:
+                copy_to_contents = self.render_copy_to()
+                self.fingerprint = self.compute_fingerprint(copy_to_contents)
+                if self.is_up_to_date(self.fingerprint):
+                    Logger.log("Job %d: the job with JOB_ID %s is up to date, skipping it" % (self.tid, self.state["JOB_ID"]), Logger.INFO)
+                    self._record(self.state, "end", status="unchanged")
+                    return False
+                
+            if self.state["JOB_ID"] in Job.staged:
+                self.working_dir = Job.staged[self.state["JOB_ID"]]
+                if self.working_dir is None:
+                    raise Job.SafeError("Job %d: the job with JOB_ID %s could not be staged, aborting job" % (self.tid, self.state["JOB_ID"]))
+            elif self.was_prepared():
+                self.working_dir = self.target_dir()
+            else:
+                self.stage(copy_to_contents)
+        except Job.SafeError as e:
+            Logger.log(e, Logger.WARNING)
+            return False
+        
+        return True
+    
+    # returns True if the current state has been staged by --prepare-only. The marker is consumed, since the working 
+    # directory will change as soon as the job runs
+    def was_prepared(self):
+        path = os.path.join(self.target_dir(), Job.STAGED_PREFIX + str(self.state["JOB_ID"]))
+        try:
+            with open(path) as f:
+                prepared = f.read().strip() == Job.state_hash(self.state)
+            os.remove(path)
+        except OSError:
+            return False
+        return prepared
+    
+    def is_up_to_date(self, fingerprint):
+        try:
+            with open(os.path.join(self.target_dir(), Job.MARKER_FILE)) as f:
+                fields = f.read().split()
+        except OSError:
+            return False
+        return len(fields) > 0 and fields[0] == fingerprint
+    
+    def _release(self, held_dirs):
+        with self.dir_taken_lock:
+            for d in held_dirs:
+                Job.dir_taken[d] = False
+    
+    def _log_exit_code(self, state, key, exit_code):
+        if key == "cd":
+            Logger.log("Job %d: can't enter the working directory of the job with JOB_ID %s" % (self.tid, state["JOB_ID"]), Logger.ERROR)
+        elif key == "Execute":
+            Logger.log("Job %d: the job with JOB_ID %s returned %d" % (self.tid, state["JOB_ID"], exit_code), Logger.DEBUG)
+        elif exit_code != 0:
+            Logger.log("Job %d: the %s command '%s' returned %d" % (self.tid, key, state[key], exit_code), Logger.ERROR)
+
+    def _run_state(self):
+        self._record(self.state, "start", dir=self.working_dir)
+        status = "failed"
         
-        os.chdir(self.working_dir)
+        pre_exit_code = 0
+        if self.state["PreExecute"] != "":
+            pre_exit_code = yield from self._phase("PreExecute")
+                
+        if pre_exit_code == 0:
+            relaunch = "Relaunch" in self.state and self.state["Relaunch"] == "True"
+            execute = True
+            exit_code = 0
+            while execute:
+                exit_code = yield from self._phase("Execute")
+                # if Relaunch is True then we relaunch the process if its previous exit code was non-zero
+                execute = relaunch and exit_code != 0
+            self._log_exit_code(self.state, "Execute", exit_code)
+                
+            if exit_code == 0:
+                post_exit_code = 0
+                if self.state["PostExecute"] != "":
+                    post_exit_code = yield from self._phase("PostExecute")
+                    self._log_exit_code(self.state, "PostExecute", post_exit_code)
+                if post_exit_code == 0:
+                    status = "done"
+                    self._mark_done(self.working_dir, self.fingerprint)
+        else:
+            self._log_exit_code(self.state, "PreExecute", pre_exit_code)
+            
+        self._record(self.state, "end", status=status)
+            
+    # returns a shell script that runs the given states one after the other, with the same logic as _run_state. 
+    # The exit codes are appended to status_file as "index key exit_code" lines. If timed is True, each line also 
+    # contains the times at which the command started and ended
+    def _batch_script(self, ready, status_file, timed):
+        status = shlex.quote(status_file)
+        # the times are taken only if they are needed, since each of them costs a process
+        start = "s=$(date +%s.%N); " if timed else ""
+        end = " $s $(date +%s.%N)" if timed else ""
+        lines = []
+        for i, (state, working_dir, fingerprint) in enumerate(ready):
+            # commands are run in subshells so that e.g. a cd or an exit do not affect the other states. The newline 
+            # before the closing parenthesis makes sure that the latter is not commented out
+            def run(key):
+                return "( %s\n); r=$?" % self.expand_cores(state[key])
+            
+            def report(key):
+                return "echo %d %s $r%s >> %s" % (i, key, end, status)
+            
+            lines.append("if cd %s; then" % shlex.quote(working_dir))
+            lines.append("r=0")
+            if state["PreExecute"] != "":
+                lines.append("%s%s; %s" % (start, run("PreExecute"), report("PreExecute")))
+            lines.append("if [ $r -eq 0 ]; then")
+            lines.append(start + run("Execute"))
+            if "Relaunch" in state and state["Relaunch"] == "True":
+                lines.append("while [ $r -ne 0 ]; do %s; done" % run("Execute"))
+            lines.append(report("Execute"))
+            if state["PostExecute"] != "":
+                lines.append("if [ $r -eq 0 ]; then %s%s; %s; fi" % (start, run("PostExecute"), report("PostExecute")))
+            lines.append("fi")
+            lines.append("else echo %d cd 1 >> %s; fi" % (i, status))
         
-        p = subprocess.Popen(cmd, shell=True, cwd=self.working_dir)
+        return "\n".join(lines) + "\n"
+    
+    # runs all the states of the batch in a single shell process
+    def _run_batch(self, batch, held_dirs):
+        ready = []
+        for state in batch:
+            if self._prepare(state, held_dirs):
+                ready.append((state, self.working_dir, self.fingerprint))
+                self._record(state, "start", dir=self.working_dir)
         
-        os.chdir(self.original_dir)
-
-        Job.dir_lock.release()
-
-        _, status = os.waitpid(p.pid, 0)
+        if len(ready) == 0:
+            return
         
-        return os.WEXITSTATUS(status)
-
-    def run(self):
-        while True:
-            self.state = Job.queue.get(True)
-
-            if "DirectoryStructure" in self.state:
-                self.relative_dir = self.state['DirectoryStructure']
-            else:
-                self.relative_dir = "."
-
-            if self.state["Exclusive"] == "True":
-                self.dir_taken_lock.acquire()
-                run = not self.is_directory_used()
-                if run:
-                    Job.dir_taken[self.relative_dir] = True
-                self.dir_taken_lock.release()
-            else:
-                run = True
-
-            if run:
-                try:
-                    self.create_dir_structure()
-                    self.create_copy_to()
-                    self.copy_objects()
-                except Job.SafeError as e:
-                    Logger.log(e, Logger.WARNING)
-                    if Job.dir_lock.locked():
-                        Job.dir_lock.release()
-                else:
-                    pre_exit_code = 0
-                    if self.state["PreExecute"] != "":
-                        pre_exit_code = self._execute(self.state["PreExecute"])
-                            
-                    if pre_exit_code == 0:
-                        relaunch = "Relaunch" in self.state and self.state["Relaunch"] == "True"
-                        execute = True
-                        exit_code = 0
-                        while execute:
-                            exit_code = self._execute(self.state["Execute"])
-                            # if Relaunch is True then we relaunch the process if its previous exit code was non-zero
-                            execute = relaunch and exit_code != 0
-                            
-                        if exit_code == 0:
-                            if self.state["PostExecute"] != "":
-                                post_exit_code = self._execute(self.state["PostExecute"])
-                                if post_exit_code != 0:
-                                    Logger.log("Job %d: the PostExecute command '%s' returned %d" % (self.tid, self.state["PreExecute"], post_exit_code), Logger.ERROR)
-                    else:
-                        Logger.log("Job %d: the PreExecute command '%s' returned %d" % (self.tid, self.state["PreExecute"], pre_exit_code), Logger.ERROR)
+        # the exit codes of the single states are written to a file, so that the output of the commands is left alone
+        fd, status_file = tempfile.mkstemp(prefix="pyrla_", suffix=".status")
+        os.close(fd)
+        Job.status_files.add(status_file)
+        try:
+            yield self._batch_script(ready, status_file, self.journal is not None), True, self.original_dir, self.cores
+            
+            exit_codes = [{} for _ in ready]
+            with open(status_file) as f:
+                for line in f:
+                    fields = line.split()
+                    # the last line may be incomplete if the shell has been killed
+                    if len(fields) < 3:
+                        continue
+                    i, key, exit_code = int(fields[0]), fields[1], int(fields[2])
+                    exit_codes[i][key] = exit_code
+                    self._log_exit_code(ready[i][0], key, exit_code)
+                    if key != "cd":
+                        timing = {}
+                        try:
+                            timing["duration"] = round(float(fields[4]) - float(fields[3]), 3)
+                        except (IndexError, ValueError):
+                            # date may not support %N
+                            pass
+                        self._record(ready[i][0], "phase", phase=key, exit_code=exit_code, **timing)
                         
-                if self.state["Exclusive"] == "True":
-                    self.dir_taken_lock.acquire()
-                    Job.dir_taken[self.relative_dir] = False
-                    self.dir_taken_lock.release()
-
-            Job.queue.task_done()
-
-
-class StateFactory(object):
-    def __init__(self, values, modifiers):
-        self.values = list(values)
-        self.modifiers = list(modifiers)
-        self.last_val = len(self.values) - 1
-        self.changing_key = self.last_val
-        self.max_changed = self.last_val
-        self.first = True
-        self.current_id = 0
-
-        self.order_by_dependencies()
-
-        for v in self.values:
-            v.expand()
-
-        self.conditions = []            
-        condition_key = [k for k in self.values if k.key == "RunConditions"]
-        if len(condition_key) > 0:
-            self.conditions = [c.strip() for c in condition_key[0]().split(",")]
+            for (state, working_dir, fingerprint), codes in zip(ready, exit_codes):
+                # states without exit codes did not run (e.g. because the shell was killed)
+                if len(codes) > 0:
+                    done = codes.get("Execute", 1) == 0 and codes.get("PostExecute", 0) == 0
+                    self._record(state, "end", status="done" if done else "failed")
+                    if done:
+                        self._mark_done(working_dir, fingerprint)
+        finally:
+            Job.status_files.discard(status_file)
+            os.remove(status_file)
             
-    def get_constant_keys(self):
-        return [k for k in self.values if type(k) == BaseKey and not k.has_modifiers()]
-
-    # we need to order values by dependency because otherwise we would end up with 
-    # unpredictable states
-    def order_by_dependencies(self):
-        # we split the values according to their dependencies: nodep will contain 
-        # those keys that do not depend on anything while with dep will contain, in 
-        # a ordered mode, all the keys that depend on other keys
-        nodep = []
-        withdep = []
-        for i in range(len(self.values)):
-            val = self.values[i]
-            if not val.has_dependencies():
-                nodep.append(val)
+    def remove_status_files():
+        for status_file in list(Job.status_files):
+            try:
+                os.remove(status_file)
+            except OSError:
+                pass
+    remove_status_files = staticmethod(remove_status_files)
+
+    # the life cycle of a batch of states, shared by all the engines. Each yielded value is a (command, use_shell, 
+    # working directory, cores) tuple describing a command that the engine should run and whose exit code should be sent back
+    # if admitted is True, the caller has already waited for the admission control (see AsyncioEngine)
+    def lifecycle(self, batch, admitted=False):
+        # the check is done when the job is about to start, since the batch may have waited in a queue for a while
+        if Job.admission is not None and not admitted:
+            Job.admission.wait()
+        held_dirs = set()
+        if Job.core_pool is not None:
+            self.cores = Job.core_pool.acquire(Job.cores_needed(batch))
+        try:
+            if len(batch) == 1:
+                if self._prepare(batch[0], held_dirs):
+                    yield from self._run_state()
             else:
-                found = False
-                for j in range(len(withdep)):
-                    if withdep[j].depends_on(val.key):
-                        withdep.insert(j, val)
-                        found = True
-                        break
-
-                if not found:
-                    withdep.append(val)
-
-        self.values = nodep + withdep
-
-    def _next_candidate_state(self):
-        if not self.first:
-            changed = False
-            # in this loop we cycle through all the values of the keys
-            while not changed:
-                if self.values[self.changing_key].set_next_value():
-                    changed = True
-
+                yield from self._run_batch(batch, held_dirs)
+        finally:
+            self._release(held_dirs)
+            if self.cores is not None:
+                Job.core_pool.release(self.cores)
+                self.cores = None
+            
+            
+class Journal(object):
+    # an append-only log of the life cycle of the jobs, stored as one JSON record per line. Records are flushed as soon 
+    # as they are written, while a background thread syncs them to disk every sync_interval seconds (if needed)
+    
+    def __init__(self, filename, sync_interval=1.0):
+        self.file = open(filename, "a")
+        self.lock = threading.Lock()
+        self.sync_interval = sync_interval
+        # True if some records have been written since the last sync
+        self.dirty = False
+        self.closed = threading.Event()
+        self.syncer = threading.Thread(target=self._sync_loop)
+        self.syncer.daemon = True
+        self.syncer.start()
+        
+    def _sync_loop(self):
+        while not self.closed.wait(self.sync_interval):
+            with self.lock:
+                dirty = self.dirty
+                self.dirty = False
+            # the file is not closed before this thread is over, and fsync does not need the lock
+            if dirty:
+                os.fsync(self.file.fileno())
+        
+    def write(self, record):
+        record["time"] = round(timestamp(), 3)
+        self.write_all([record])
+                
+    def close(self):
+        self.closed.set()
+        self.syncer.join()
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+    
+    # writes records that already have a time (e.g. those sent by the workers)
+    def write_all(self, records):
+        lines = [json.dumps(record) + "\n" for record in records]
+        with self.lock:
+            self.file.writelines(lines)
+            self.file.flush()
+            self.dirty = True
+    
+    # returns a Counter that maps the (JOB_ID, state hash) pairs of the jobs recorded in filename to the number of
+    # times they completed successfully
+    def completed(filename):
+        completed = collections.Counter()
+        if not os.path.isfile(filename):
+            return completed
+        
+        with open(filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may have been truncated by a crash
+                    continue
+                if record.get("event") == "end" and record.get("status") == "done":
+                    completed[(record["job_id"], record["hash"])] += 1
+        return completed
+    completed = staticmethod(completed)
+            
+            
+class MemoryJournal(list):
+    # keeps the records in memory, so that workers can send them to the coordinator
+    def write(self, record):
+        record["time"] = round(timestamp(), 3)
+        self.append(record)
+        
+        
+class ThreadEngine(object):
+    # each job is run by a thread that waits for its commands to finish
+    
+    def __init__(self, max_jobs, safe):
+        self.max_jobs = max_jobs
+        self.safe = safe
+        self.queue = queue.Queue(1)
+        self.num_threads = 0
+        # if not None, it is called with each batch whose states are over
+        self.on_done = None
+        
+    def _execute(self, job, command, use_shell, working_dir, cores):
+        # the working directory is set in the child process only, so that there is no need to change the launcher's 
+        # directory and jobs can be spawned concurrently. Since there is no preexec_fn, Popen can spawn the child 
+        # with vfork/posix_spawn
+        try:
+            p = Command.popen_pinned(command, use_shell, cores, cwd=working_dir)
+        except OSError as e:
+            Logger.log("Job %d: can't run '%s' (error: %s)" % (job.tid, command, e), Logger.ERROR)
+            return 127
+        
+        return Command.exit_code(p.wait())
+        
+    # runs the whole life cycle of the batch, waiting for each of its commands to finish
+    def run_batch(self, job, batch):
+        lifecycle = job.lifecycle(batch)
+        try:
+            command = next(lifecycle)
+            while True:
+                command = lifecycle.send(self._execute(job, *command))
+        except StopIteration:
+            pass
+        
+    def _worker(self, job):
+        while True:
+            batch = self.queue.get(True)
+            try:
+                self.run_batch(job, batch)
+            except Exception as e:
+                Logger.log("Job %d: unexpected error (%s), aborting job" % (job.tid, e), Logger.ERROR)
+            finally:
+                if self.on_done is not None:
+                    self.on_done(batch)
+                # this should always be done, otherwise join would never return
+                self.queue.task_done()
+                
+    # blocks until a worker is free to run the batch. Workers are spawned only when needed, so that we never have 
+    # more threads than states
+    def submit(self, batch, first_round):
+        if (self.max_jobs == 0 and first_round) or self.num_threads < self.max_jobs:
+            t = threading.Thread(target=self._worker, args=(Job(self.num_threads, self.safe),))
+            t.daemon = True
+            t.start()
+            self.num_threads += 1
+            
+        self.queue.put(batch, block=True)
+        
+    def join(self):
+        self.queue.join()
+        
+        
+class AsyncioEngine(object):
+    # all the jobs are supervised by a single thread running an asyncio event loop
+    EXECUTOR_THREADS = 4
+    
+    def __init__(self, max_jobs, safe):
+        self.max_jobs = max_jobs
+        self.safe = safe
+        self.slots = threading.Semaphore(max_jobs) if max_jobs > 0 else None
+        # the ids of the jobs that are over, which are reused so that ids go from 0 to max_jobs - 1, as with threads
+        self.free_tids = []
+        self.num_tids = 0
+        self.pending = 0
+        self.done = threading.Condition()
+        # if not None, it is called with each batch whose states are over
+        self.on_done = None
+        # runs the parts of the life cycle of the jobs that are not commands (staging, fingerprinting, journaling...), 
+        # which may block on I/O and hence should not run on the event loop. Nothing else waits in these threads (commands 
+        # and admission control are awaited on the loop), so a few of them are enough for any number of jobs
+        self.executor = ThreadPoolExecutor(max_workers=AsyncioEngine.EXECUTOR_THREADS)
+        
+        self.loop = asyncio.new_event_loop()
+        # jobs that are about to start wait for the admission control one at a time (see AdmissionControl.wait)
+        self.admission_lock = None
+        # before python 3.12 asyncio waits for each child process in a dedicated thread, unless told otherwise
+        if sys.version_info < (3, 12) and AsyncioEngine._can_use_pidfd():
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(self.loop)
+            asyncio.set_child_watcher(watcher)
+        
+        t = threading.Thread(target=self.loop.run_forever)
+        t.daemon = True
+        t.start()
+        
+    def _can_use_pidfd():
+        if not hasattr(asyncio, "PidfdChildWatcher") or not hasattr(os, "pidfd_open"):
+            return False
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except OSError:
+            return False
+        return True
+    _can_use_pidfd = staticmethod(_can_use_pidfd)
+    
+    # runs the life cycle up to its next command, which is returned (None if the life cycle is over). StopIteration 
+    # can't be propagated through an asyncio future, hence it is caught here
+    def _advance(lifecycle, exit_code):
+        try:
+            return lifecycle.send(exit_code)
+        except StopIteration:
+            return None
+    _advance = staticmethod(_advance)
+        
+    async def _execute(self, job, command, use_shell, working_dir, cores):
+        args = Command.split(command, use_shell)
+        # all the processes are spawned by the thread of the event loop, whose affinity can't be changed for each of 
+        # them (see Command.popen_pinned) since spawning is not atomic, hence pinned processes are pinned by a preexec_fn
+        preexec_fn = Command.pinner(cores)
+        try:
+            if args is not None:
+                try:
+                    p = await asyncio.create_subprocess_exec(*args, cwd=working_dir, preexec_fn=preexec_fn)
+                except OSError:
+                    # see Command.popen
+                    if use_shell is False:
+                        raise
+                    args = None
+            if args is None:
+                p = await asyncio.create_subprocess_shell(command, cwd=working_dir, preexec_fn=preexec_fn)
+        except OSError as e:
+            Logger.log("Job %d: can't run '%s' (error: %s)" % (job.tid, command, e), Logger.ERROR)
+            return 127
+        
+        return Command.exit_code(await p.wait())
+        
+    # the equivalent of AdmissionControl.wait that sleeps on the event loop rather than in a thread
+    async def _admit(self):
+        # the lock must be created by the thread running the loop
+        if self.admission_lock is None:
+            self.admission_lock = asyncio.Lock()
+        async with self.admission_lock:
+            for interval in Job.admission.pauses():
+                await asyncio.sleep(interval)
+        
+    async def _run(self, batch):
+        if len(self.free_tids) > 0:
+            tid = self.free_tids.pop()
+        else:
+            tid = self.num_tids
+            self.num_tids += 1
+        
+        job = Job(tid, self.safe)
+        lifecycle = job.lifecycle(batch, admitted=Job.admission is not None)
+        try:
+            if Job.admission is not None:
+                await self._admit()
+            # the commands are awaited on the event loop, everything else runs in the executor
+            command = await self.loop.run_in_executor(self.executor, AsyncioEngine._advance, lifecycle, None)
+            while command is not None:
+                exit_code = await self._execute(job, *command)
+                command = await self.loop.run_in_executor(self.executor, AsyncioEngine._advance, lifecycle, exit_code)
+        except Exception as e:
+            Logger.log("Job %d: unexpected error (%s), aborting job" % (job.tid, e), Logger.ERROR)
+        finally:
+            lifecycle.close()
+            self.free_tids.append(tid)
+            if self.on_done is not None:
+                self.on_done(batch)
+            if self.slots is not None:
+                self.slots.release()
+            with self.done:
+                self.pending -= 1
+                self.done.notify_all()
+        
+    # blocks until there is a free slot to run the batch
+    def submit(self, batch, first_round):
+        if self.slots is not None:
+            self.slots.acquire()
+        with self.done:
+            self.pending += 1
+        asyncio.run_coroutine_threadsafe(self._run(batch), self.loop)
+        
+    def join(self):
+        with self.done:
+            while self.pending > 0:
+                self.done.wait()
+
+
+class Protocol(object):
+    # the coordinator and the workers exchange JSON messages, one per line
+    
+    def send(f, message):
+        f.write((json.dumps(message) + "\n").encode())
+        f.flush()
+    send = staticmethod(send)
+    
+    # returns None if the connection has been closed
+    def receive(f):
+        line = f.readline()
+        if len(line) == 0:
+            return None
+        return json.loads(line.decode())
+    receive = staticmethod(receive)
+    
+    # addresses are either host:port pairs or paths to Unix sockets
+    def parse_address(address):
+        if "/" in address:
+            return socket.AF_UNIX, address
+        host, _, port = address.rpartition(":")
+        return socket.AF_INET, (host if host != "" else "localhost", int(port))
+    parse_address = staticmethod(parse_address)
+    
+    
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    # serves a single worker slot
+    
+    def handle(self):
+        engine = self.server.engine
+        batch = None
+        hello = None
+        name = "%s" % (self.client_address,)
+        try:
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            hello = Protocol.receive(self.rfile)
+            if hello is None or hello.get("type") != "hello":
+                return
+            name = hello["name"]
+            Logger.log("Worker %s connected" % name, Logger.INFO)
+            engine.connected(1)
+            Protocol.send(self.wfile, engine.config)
+            
+            while True:
+                message = Protocol.receive(self.rfile)
+                if message is None:
+                    break
+                if message.get("type") != "get":
+                    continue
+                
+                batch = engine.next_batch()
+                if batch is None:
+                    Protocol.send(self.wfile, {"type" : "done"})
+                    break
+                
+                Protocol.send(self.wfile, {"type" : "batch", "states" : batch})
+                # while the batch runs the worker sends heartbeats: if neither a heartbeat nor the result arrives 
+                # within the lease, the worker is considered lost (e.g. it hangs or it is behind a network partition)
+                self.request.settimeout(CoordinatorEngine.LEASE_TIMEOUT)
+                result = Protocol.receive(self.rfile)
+                while result is not None and result.get("type") == "heartbeat":
+                    result = Protocol.receive(self.rfile)
+                self.request.settimeout(None)
+                if result is None or result.get("type") != "result":
+                    break
+                engine.complete(batch, result, name)
+                batch = None
+        except (OSError, ValueError) as e:
+            Logger.log("Lost connection with worker %s (error: %s)" % (name, e), Logger.DEBUG)
+        finally:
+            # the worker died while running the batch
+            if batch is not None:
+                engine.requeue(batch, name)
+            if hello is not None and hello.get("type") == "hello":
+                engine.connected(-1)
+                Logger.log("Worker %s disconnected" % name, Logger.INFO)
+            
+            
+class CoordinatorEngine(object):
+    # states are not run locally, but pulled by the pyrla workers (see Worker) connected to address, so that they 
+    # are balanced among them dynamically. Batches taken by workers that are lost are given to other workers
+    # the number of seconds a worker can remain silent while running a batch before the batch is given to another worker
+    LEASE_TIMEOUT = 60.
+    
+    def __init__(self, address, input_file, safe):
+        self.queue = queue.Queue(1)
+        self.retry = collections.deque()
+        self.pending = 0
+        self.finished = False
+        self.num_workers = 0
+        self.cond = threading.Condition()
+        # if not None, it is called with each batch whose states are over
+        self.on_done = None
+        # workers need the input file (which should be reachable at the same path) for the global options
+        self.config = {"type" : "config", "input" : os.path.abspath(input_file), "cwd" : os.getcwd(), "safe" : safe}
+        
+        family, server_address = Protocol.parse_address(address)
+        if family == socket.AF_UNIX:
+            # remove a stale socket left by a previous coordinator
+            if os.path.exists(server_address) and stat.S_ISSOCK(os.stat(server_address).st_mode):
+                os.remove(server_address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+            
+        try:
+            self.server = server_class(server_address, CoordinatorHandler, bind_and_activate=False)
+            self.server.allow_reuse_address = True
+            self.server.daemon_threads = True
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError as e:
+            Logger.log("Can't listen on '%s' (error: %s)" % (address, e), Logger.CRITICAL)
+            exit(1)
+        self.server.engine = self
+        
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        Logger.log("Waiting for workers on %s" % address, Logger.INFO)
+        
+    # returns the next batch to be run, or None if there are no more batches
+    def next_batch(self):
+        while True:
+            with self.cond:
+                if len(self.retry) > 0:
+                    return self.retry.popleft()
+                if self.finished:
+                    return None
+            try:
+                return self.queue.get(timeout=0.2)
+            except queue.Empty:
+                pass
+            
+    def complete(self, batch, result, name):
+        Logger.log("Worker %s ran the jobs with JOB_IDs %s in %.3f seconds" % (name, ", ".join(state["JOB_ID"] for state in batch), result.get("duration", 0)), Logger.DEBUG)
+        if Job.journal is not None:
+            Job.journal.write_all(result.get("records", []))
+        if self.on_done is not None:
+            self.on_done(batch)
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+            
+    def connected(self, delta):
+        with self.cond:
+            self.num_workers += delta
+            self.cond.notify_all()
+            
+    def requeue(self, batch, name):
+        Logger.log("Worker %s has been lost, the jobs with JOB_IDs %s will be run again" % (name, ", ".join(state["JOB_ID"] for state in batch)), Logger.WARNING)
+        with self.cond:
+            self.retry.append(batch)
+            
+    # blocks until a worker asks for the batch
+    def submit(self, batch, first_round):
+        with self.cond:
+            self.pending += 1
+        self.queue.put(batch, block=True)
+        
+    def join(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+            self.finished = True
+            
+            # we give the workers some time to be told that there is nothing left to do
+            deadline = monotonic() + 5.
+            while self.num_workers > 0 and monotonic() < deadline:
+                self.cond.wait(deadline - monotonic())
+            
+            
+class Worker(object):
+    # pulls batches of states from a coordinator (see CoordinatorEngine) and runs them in num_jobs parallel slots, each 
+    # with its own connection
+    CONNECT_ATTEMPTS = 30
+    # how often (in seconds) the coordinator is told that a batch is still running (see CoordinatorEngine.LEASE_TIMEOUT)
+    HEARTBEAT_INTERVAL = 10.
+    
+    def __init__(self, address, num_jobs):
+        self.address = address
+        self.num_jobs = num_jobs
+        self.lock = threading.Lock()
+        self.engine = None
+        # if not None, the ResourceScheduler that keeps track of the resources used by the slots of this worker
+        self.resources = None
+        self.safe = False
+        
+    # the global options are taken from the coordinator's input file. Resources (see JobCores and the like) are 
+    # accounted for by each worker, and their availability (e.g. the number of cores if HostCores is not set) refers 
+    # to the worker's host
+    def _configure(self, config):
+        with self.lock:
+            if self.engine is not None:
+                return
+            os.chdir(config["cwd"])
+            launcher = Launcher(config["input"])
+            launcher.configure_jobs()
+            if len(launcher.capacity) > 0:
+                self.resources = ResourceScheduler(None, launcher.capacity, launcher.scheduler_policy, launcher.scheduler_window)
+                Logger.log("Available resources: %s" % ", ".join("%s = %s" % (k, launcher.capacity[k]) for k in sorted(launcher.capacity)), Logger.INFO)
+            self.safe = config["safe"]
+            self.engine = ThreadEngine(1, self.safe)
+            
+    def _connect(self):
+        family, address = Protocol.parse_address(self.address)
+        for attempt in range(Worker.CONNECT_ATTEMPTS):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                if attempt == Worker.CONNECT_ATTEMPTS - 1:
+                    raise
+                sleep(1)
+        
+    def _slot(self, tid):
+        try:
+            sock = self._connect()
+        except OSError as e:
+            Logger.log("Can't connect to the coordinator at '%s' (error: %s)" % (self.address, e), Logger.ERROR)
+            return
+        
+        try:
+            with sock, sock.makefile("rwb") as f:
+                Protocol.send(f, {"type" : "hello", "name" : "%s:%d/%d" % (socket.gethostname(), os.getpid(), tid)})
+                config = Protocol.receive(f)
+                if config is None:
+                    return
+                self._configure(config)
+                
+                job = Job(tid, self.safe)
+                send_lock = threading.Lock()
+                while True:
+                    Protocol.send(f, {"type" : "get"})
+                    message = Protocol.receive(f)
+                    if message is None or message["type"] == "done":
+                        break
+                    
+                    job.journal = MemoryJournal()
+                    start = monotonic()
+                    finished = threading.Event()
+                    heartbeat = threading.Thread(target=self._heartbeat, args=(f, send_lock, finished))
+                    heartbeat.daemon = True
+                    heartbeat.start()
+                    try:
+                        if self.resources is not None:
+                            self.resources.acquire(message["states"])
+                        try:
+                            self.engine.run_batch(job, message["states"])
+                        finally:
+                            if self.resources is not None:
+                                self.resources.release(message["states"])
+                    except Exception as e:
+                        Logger.log("Job %d: unexpected error (%s), aborting job" % (tid, e), Logger.ERROR)
+                    finally:
+                        finished.set()
+                    with send_lock:
+                        Protocol.send(f, {"type" : "result", "records" : job.journal, "duration" : monotonic() - start})
+        except (OSError, ValueError) as e:
+            Logger.log("Lost connection with the coordinator (error: %s)" % e, Logger.ERROR)
+            
+    # tells the coordinator that the batch is still running until finished is set
+    def _heartbeat(self, f, send_lock, finished):
+        while not finished.wait(Worker.HEARTBEAT_INTERVAL):
+            try:
+                with send_lock:
+                    if not finished.is_set():
+                        Protocol.send(f, {"type" : "heartbeat"})
+            except (OSError, ValueError):
+                return
+            
+    def run(self):
+        threads = [threading.Thread(target=self._slot, args=(i,)) for i in range(self.num_jobs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    
+    
+class Host(object):
+    # the resources of the host pyrla runs on
+    
+    # returns the sorted list of the cores pyrla is allowed to run on
+    def cores():
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count()))
+    cores = staticmethod(cores)
+    
+    # returns the value in MB of the given field of /proc/meminfo (e.g. MemTotal or MemAvailable), or None if it can't 
+    # be found
+    def memory(field):
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        return float(line.split()[1]) / 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+    memory = staticmethod(memory)
+    
+    
+class CorePool(object):
+    # assigns the least loaded cores to each job, so that running jobs get disjoint sets of cores as long as there are
+    # enough of them. If numa is True, the cores of each job are taken from a single NUMA node whenever possible
+    
+    def __init__(self, numa):
+        self.cores = Host.cores()
+        self.nodes = CorePool.numa_nodes(self.cores) if numa else [self.cores]
+        # the number of running jobs pinned to each core
+        self.load = dict((c, 0) for c in self.cores)
+        self.lock = threading.Lock()
+        
+    # parses lists of cores such as "0-3,8,10-11"
+    def parse_cpulist(cpulist):
+        cores = []
+        for item in cpulist.strip().split(","):
+            if "-" in item:
+                first, last = item.split("-")
+                cores.extend(range(int(first), int(last) + 1))
+            elif item != "":
+                cores.append(int(item))
+        return cores
+    parse_cpulist = staticmethod(parse_cpulist)
+    
+    # returns the lists of the given cores that belong to the same NUMA node
+    def numa_nodes(cores):
+        nodes = []
+        remaining = set(cores)
+        for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"), key=lambda p: int(p.rpartition("node")[2])):
+            try:
+                with open(os.path.join(path, "cpulist")) as f:
+                    node = [c for c in CorePool.parse_cpulist(f.read()) if c in remaining]
+            except (OSError, ValueError):
+                continue
+            if len(node) > 0:
+                nodes.append(node)
+                remaining.difference_update(node)
+                
+        if len(remaining) > 0:
+            nodes.append(sorted(remaining))
+        return nodes
+    numa_nodes = staticmethod(numa_nodes)
+    
+    def acquire(self, n):
+        n = min(n, len(self.cores))
+        with self.lock:
+            best = None
+            for node in self.nodes:
+                if len(node) >= n:
+                    candidate = sorted(node, key=lambda c: self.load[c])[:n]
+                    if best is None or sum(self.load[c] for c in candidate) < sum(self.load[c] for c in best):
+                        best = candidate
+            # the job does not fit in any node
+            if best is None:
+                best = sorted(self.cores, key=lambda c: self.load[c])[:n]
+                
+            for c in best:
+                self.load[c] += 1
+                
+        return sorted(best)
+    
+    def release(self, cores):
+        with self.lock:
+            for c in cores:
+                self.load[c] -= 1
+                
+                
+class ResourceScheduler(object):
+    # the resources that can be requested by each state, together with the keys that set their availability on the host
+    RESOURCES = (("JobCores", "HostCores"), ("JobMemory", "HostMemory"), ("JobSlots", "HostSlots"))
+    POLICIES = ("Fifo", "Backfill")
+    MEMORY_UNITS = {"K" : 1. / 1024, "M" : 1., "G" : 1024., "T" : 1024. * 1024.}
+    
+    # capacity maps each resource to the amount available on the host (None means unlimited). Batches are submitted 
+    # to the engine only when their requirements fit, and at most window batches are kept waiting. If engine is None, 
+    # batches are not submitted but run by the caller between acquire and release (see Worker)
+    def __init__(self, engine, capacity, policy, window):
+        self.engine = engine
+        if self.engine is not None:
+            self.engine.on_done = self.release
+        self.capacity = capacity
+        self.used = dict((k, 0.) for k in capacity)
+        self.policy = policy
+        self.window = window
+        self.pending = collections.deque()
+        # the number of batches that have been started ahead of the first pending batch
+        self.bypassed = 0
+        self.cond = threading.Condition()
+        
+    
+    # parses an amount of memory given in MB or with a K, M, G or T suffix
+    def parse_memory(value):
+        value = value.strip().upper().rstrip("B")
+        if len(value) > 0 and value[-1] in ResourceScheduler.MEMORY_UNITS:
+            return float(value[:-1]) * ResourceScheduler.MEMORY_UNITS[value[-1]]
+        return float(value)
+    parse_memory = staticmethod(parse_memory)
+    
+    # the states of a batch run one after the other, so the batch needs the largest amount of each resource requested 
+    # by its states
+    def requirements(self, batch):
+        req = {}
+        for key in self.capacity:
+            # each job uses at least one core
+            req[key] = 1. if key == "JobCores" else 0.
+            for state in batch:
+                if key in state:
+                    try:
+                        value = ResourceScheduler.parse_memory(state[key]) if key == "JobMemory" else float(state[key])
+                    except ValueError:
+                        Logger.log("Invalid value '%s' for the key %s of the job with JOB_ID %s" % (state[key], key, state["JOB_ID"]), Logger.CRITICAL)
+                        exit(1)
+                    req[key] = max(req[key], value)
+        return req
+    
+    def _fits(self, req):
+        return all(self.capacity[k] is None or self.used[k] + req[k] <= self.capacity[k] for k in req)
+    
+    # returns the index of the pending batch that should be started next, or None if no batch can be started
+    def _pick(self):
+        if len(self.pending) == 0:
+            return None
+        
+        if self._fits(self.pending[0][1]):
+            return 0
+        # a batch requiring more than the whole host is started as soon as the host is idle
+        if all(v == 0 for v in self.used.values()):
+            return 0
+        
+        # once too many batches have been started ahead of it, the first batch waits for the resources to free up, 
+        # so that it does not starve
+        if self.policy == "Backfill" and self.bypassed < self.window:
+            for i in range(1, len(self.pending)):
+                if self._fits(self.pending[i][1]):
+                    return i
+        return None
+    
+    # starts all the pending batches that fit, waiting until at most max_pending batches are left
+    def _dispatch(self, max_pending):
+        while True:
+            with self.cond:
+                i = self._pick()
+                while i is None:
+                    if len(self.pending) <= max_pending:
+                        return
+                    self.cond.wait()
+                    i = self._pick()
+                    
+                batch, req, first_round = self.pending[i]
+                del self.pending[i]
+                for k in req:
+                    self.used[k] += req[k]
+                self.bypassed = 0 if i == 0 else self.bypassed + 1
+                
+            for state in batch:
+                Logger.log("Starting the job with JOB_ID %s (%s)" % (state["JOB_ID"], ", ".join("%s = %g" % (k, req[k]) for k in sorted(req))), Logger.DEBUG)
+            self.engine.submit(batch, first_round)
+        
+    # blocks until the requirements of the batch fit (or the host is idle)
+    def acquire(self, batch):
+        req = self.requirements(batch)
+        with self.cond:
+            while not self._fits(req) and not all(v == 0 for v in self.used.values()):
+                self.cond.wait()
+            for k in req:
+                self.used[k] += req[k]
+        
+    def release(self, batch):
+        req = self.requirements(batch)
+        with self.cond:
+            for k in req:
+                self.used[k] -= req[k]
+            self.cond.notify_all()
+        
+    def submit(self, batch, first_round):
+        with self.cond:
+            self.pending.append((batch, self.requirements(batch), first_round))
+        self._dispatch(self.window)
+        
+    def join(self):
+        self._dispatch(0)
+        self.engine.join()
+    
+    
+class RunCondition(object):
+    def __init__(self, source, keys):
+        self.source = source
+        try:
+            self.code = compile(source, "<RunConditions>", "eval")
+        except SyntaxError as e:
+            Logger.log("Invalid run condition '%s' (error: %s)" % (source, e), Logger.CRITICAL)
+            exit(1)
+        
+        # the keys the condition is based on
+        self.keys = [k for k in keys if k in RunCondition._names(self.code)]
+        
+    def _names(code):
+        names = set(code.co_names) | set(code.co_varnames)
+        # lambdas and comprehensions have their own code objects
+        for const in code.co_consts:
+            if isinstance(const, type(code)):
+                names |= RunCondition._names(const)
+        return names
+    _names = staticmethod(_names)
+    
+    def __call__(self, key_values):
+        return eval(self.code, MATH_NAMESPACE, key_values)
+
+
+class DependencyGraph(object):
+    def __init__(self, keys):
+        self.keys = collections.OrderedDict((k.key, k) for k in keys)
+        
+        for k in self.keys.values():
+            for dep in k.depends_on_keys:
+                if dep not in self.keys:
+                    Logger.log("Key '%s' (which is expanded by '%s') is not defined" % (dep, k.key), Logger.CRITICAL)
+                    exit(1)
+                    
+        self.order = self._sort()
+        
+        # the transitive closure of the dependencies: closures are computed following the topological order, 
+        # so that the closures of the dependencies of a key are always available when the key is processed
+        self.closures = {}
+        for k in self.order:
+            closure = set()
+            for dep in k.depends_on_keys:
+                closure.add(dep)
+                closure.update(self.closures[dep])
+            self.closures[k.key] = frozenset(closure)
+            
+    # we sort the keys so that each key comes after the keys it depends on. Keys that do not depend on anything 
+    # come first, in the order they have been defined, while any other key is preceded by those of its dependencies 
+    # that have not been placed yet. This is a depth-first visit that runs in O(keys + dependencies) time
+    def _sort(self):
+        order = [k for k in self.keys.values() if not k.has_dependencies()]
+        placed = set(k.key for k in order)
+        
+        for root in self.keys.values():
+            if root.key in placed:
+                continue
+            
+            # the stack contains the path from the root to the key being visited, as (key, iterator over its dependencies) pairs
+            path = [root.key]
+            stack = [(root, iter(root.depends_on_keys))]
+            while len(stack) > 0:
+                k, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    stack.pop()
+                    path.pop()
+                    if k.key not in placed:
+                        order.append(k)
+                        placed.add(k.key)
+                elif dep not in placed:
+                    if dep in path:
+                        cycle = path[path.index(dep):] + [dep]
+                        Logger.log("Circular dependency between keys (%s), aborting" % " -> ".join(cycle), Logger.CRITICAL)
+                        exit(1)
+                    path.append(dep)
+                    stack.append((self.keys[dep], iter(self.keys[dep].depends_on_keys)))
+                    
+        return order
+    
+    def closure(self, key):
+        return self.closures[key]
+            
+    def depends_on(self, key, other):
+        return other in self.closures[key]
+
+
+class StateFactory(object):
+    def __init__(self, values, modifiers):
+        self.values = list(values)
+        self.modifiers = list(modifiers)
+        self.last_val = len(self.values) - 1
+
+        self.graph = DependencyGraph(self.values)
+        self.order_by_dependencies()
+
+        for v in self.values:
+            v.expand()
+
+        keys = [v.key for v in self.values]
+        self.conditions = []            
+        condition_key = [k for k in self.values if k.key == "RunConditions"]
+        if len(condition_key) > 0:
+            self.conditions = [RunCondition(c.strip(), keys) for c in condition_key[0]().split(",")]
+            
+        # the position of the keys that take more than one value: the Cartesian product of their values 
+        # is the set of candidate states, and each candidate can be identified by a mixed-radix index whose
+        # least significant digit is the counter of the last key
+        self.multiple_keys = [i for i, v in enumerate(self.values) if isinstance(v, MultipleKey)]
+        self.random_access = self._is_random_access()
+        self._compute_triggers()
+        self._compile_conditions()
+        if self.random_access:
+            self.num_candidates = 1
+            for i in self.multiple_keys:
+                self.num_candidates *= len(self.values[i].value)
+                
+        self.reset()
+            
+    def reset(self):
+        for v in self.values:
+            if isinstance(v, MultipleKey):
+                v.reset()
+                
+        self.changing_key = self.last_val
+        self.max_changed = self.last_val
+        self.first = True
+        self.current_id = 0
+        # the values taken by the triggers of each key when the key was last expanded
+        self.signatures = [None] * len(self.values)
+            
+    def _is_random_access(self):
+        # states can be decoded from their index only if the number of values taken by each key does not 
+        # depend on the values taken by the other keys 
+        varying_keys = [self.values[i].key for i in self.multiple_keys] + ["JOB_ID"]
+        for i in self.multiple_keys:
+            for k in varying_keys:
+                if self.graph.depends_on(self.values[i].key, k):
+                    return False
+                
+        return True
+            
+    # when going from a state to the next one only the keys that depend on keys whose value has changed need 
+    # to be expanded again. Here we store, for each key, the list of the keys that trigger its expansion
+    def _compute_triggers(self):
+        self.volatile_keys = [v.key for v in self.values if v.volatile]
+        varying_keys = [self.values[i].key for i in self.multiple_keys] + ["JOB_ID"] + self.volatile_keys
+        
+        positions = dict((v.key, i) for i, v in enumerate(self.values))
+        self.triggers = []
+        self.ancestors = []
+        for i, v in enumerate(self.values):
+            closure = self.graph.closure(v.key)
+            if isinstance(v, MultipleKey):
+                # a change in the counter of a MultipleKey does not require its list of values to be recomputed
+                my_triggers = [k for k in varying_keys if k in closure]
+            else:
+                my_triggers = [k for k in varying_keys if k == v.key or k in closure]
+            self.triggers.append(my_triggers)
+            # the keys that have to be expanded before this one can be expanded (itself included)
+            self.ancestors.append(set(positions[k] for k in closure) | set([i]))
+            
+        # the odometer needs the lists of values of all the MultipleKeys to be up to date
+        self.odometer_keys = sorted(set().union(*[self.ancestors[i] for i in self.multiple_keys]))
+        self.serial = 0
+        
+    # for each condition we store the keys that need to be expanded to evaluate it and, if possible, the position 
+    # of the most rapidly changing MultipleKey it depends on. If a condition is not met, all the candidate states 
+    # that differ only by the values of the keys that come after that position can be skipped
+    def _compile_conditions(self):
+        positions = dict((v.key, i) for i, v in enumerate(self.values))
+        for c in self.conditions:
+            c.positions = [(k, positions[k]) for k in c.keys]
+            c.indexes = sorted(set().union(*[self.ancestors[i] for _, i in c.positions]))
+            # the value of a MultipleKey also depends on its own counter
+            triggers = set(self.values[i].key for i in c.indexes if isinstance(self.values[i], MultipleKey))
+            triggers.update(*[self.triggers[i] for i in c.indexes])
+            if "JOB_ID" in triggers or len(triggers.intersection(self.volatile_keys)) > 0:
+                c.prune_from = None
+            else:
+                c.prune_from = max([positions[k] for k in triggers], default=-1)
+                
+        # conditions that depend on the slowest changing keys are checked first, since they prune larger sub-trees
+        self.conditions.sort(key=lambda c: len(self.values) if c.prune_from is None else c.prune_from)
+        
+    def _varying_values(self, job_id):
+        varying_values = dict((self.values[i].key, self.values[i].counter) for i in self.multiple_keys)
+        varying_values["JOB_ID"] = job_id
+        # volatile keys should be expanded once per candidate state
+        self.serial += 1
+        for k in self.volatile_keys:
+            varying_values[k] = self.serial
+        
+        return varying_values
+    
+    def _expand_keys(self, indexes, varying_values):
+        for i in indexes:
+            signature = tuple(varying_values[k] for k in self.triggers[i])
+            if signature != self.signatures[i]:
+                v = self.values[i]
+                if v.key == "JOB_ID":
+                    v.raw_value = str(varying_values["JOB_ID"])
+                v.expand()
+                self.signatures[i] = signature
+                
+    def _build_state(self):
+        return dict((v.key, v()) for v in self.values)
+            
+    # runs all the distinct bash commands that can be known in advance using max_workers parallel shells, so 
+    # that the results will be taken from BashKey's cache when states are generated
+    def prefetch_bash_commands(self, max_workers):
+        # the commands whose output is needed to move the odometer or to evaluate the RunConditions are run 
+        # right away, since the states cannot be enumerated without them
+        needed = set(self.odometer_keys).union(*[c.indexes for c in self.conditions])
+        bash_keys = [i for i, v in enumerate(self.values) if isinstance(v, BashKey)]
+        for i in bash_keys:
+            v = self.values[i]
+            # if a command depends on the output of another command then it cannot be known in advance
+            v.prefetchable = i not in needed and not any(self.graph.depends_on(v.key, self.values[j].key) for j in bash_keys)
+        
+        # only the keys that the prefetchable commands depend on are expanded, and only for the states that 
+        # satisfy the RunConditions
+        indexes = sorted(set().union(*[self.ancestors[i] for i in bash_keys if self.values[i].prefetchable]))
+        BashKey.collected_commands = {}
+        try:
+            self.reset()
+            while self.set_next(expand=False):
+                self._expand_keys(indexes, self.varying_values)
+            commands = BashKey.collected_commands
+        finally:
+            BashKey.collected_commands = None
+            self.reset()
+        
+        BashKey.prefetch(commands, max_workers)
+            
+    def get_constant_keys(self):
+        return [k for k in self.values if type(k) == BaseKey and not k.has_modifiers()]
+    
+    # returns the number of states if it can be computed without generating them, None otherwise
+    def size(self):
+        if self.random_access and len(self.conditions) == 0:
+            return self.num_candidates
+        
+        return None
+    
+    # if limit is given the counting stops as soon as the number of states exceeds it
+    def count(self, limit=None):
+        size = self.size()
+        if size is not None:
+            return size
+        
+        self.reset()
+        while self.set_next(expand=False):
+            if limit is not None and self.current_id > limit:
+                break
+        
+        return self.current_id
+
+    # we need to order values by dependency because otherwise we would end up with 
+    # unpredictable states
+    def order_by_dependencies(self):
+        self.values = list(self.graph.order)
+    
+    # build the state whose mixed-radix index is index. Works only if self.random_access is True
+    def get_state(self, index):
+        job_id = index
+        for i in reversed(self.multiple_keys):
+            v = self.values[i]
+            index, v.counter = divmod(index, len(v.value))
+            
+        self._expand_keys(range(len(self.values)), self._varying_values(job_id))
+        
+        return self._build_state()
+
+    # moves the odometer to the next candidate state. Returns False if there are no more candidates
+    def _next_candidate(self):
+        if not self.first:
+            changed = False
+            # in this loop we cycle through all the values of the keys
+            while not changed:
+                if self.values[self.changing_key].set_next_value():
+                    changed = True
+
                     if self.max_changed >= self.changing_key:
                         self.changing_key = self.last_val
                         self.max_changed = self.changing_key
@@ -757,51 +2448,342 @@ class StateFactory(object):
                     self.changing_key -= 1
 
                 if self.max_changed < 0 or self.changing_key < 0:
-                    return None
+                    return False
 
         self.first = False
         
-        state = {}
-        for v in self.values:
-            if v.key == "JOB_ID":
-                v.raw_value = str(self.current_id)
-            v.expand()
-            state[v.key] = v()
-            
-        return state
+        return True
     
-    def set_next(self):
+    # makes the odometer skip all the candidates that share the values of the keys up to the given position
+    def _prune(self, position):
+        if position < 0:
+            # the condition does not depend on any MultipleKey: no candidate can satisfy it
+            self.changing_key = -1
+            self.max_changed = -1
+            return
+        
+        for i in self.multiple_keys:
+            if i > position:
+                self.values[i].reset()
+        self.changing_key = position
+    
+    # if expand is False, only the keys required to evaluate the RunConditions are expanded and self.next_state
+    # is set to None. This is useful to skip states quickly
+    def set_next(self, expand=True):
         state_found = False
         while not state_found:
-            next_state = self._next_candidate_state()
-            
-            if next_state is None:
+            if self.changing_key < 0 or not self._next_candidate():
                 return False
             
+            varying_values = self._varying_values(self.current_id)
+            self.varying_values = varying_values
+            self._expand_keys(self.odometer_keys, varying_values)
+            
             state_found = True
             for condition in self.conditions:
-                state_found &= eval(condition, None, next_state)
+                self._expand_keys(condition.indexes, varying_values)
+                if not condition(dict((k, self.values[i]()) for k, i in condition.positions)):
+                    state_found = False
+                    if condition.prune_from is not None:
+                        self._prune(condition.prune_from)
+                    break
                 
-        self.next_state = next_state
+        if expand:
+            self._expand_keys(range(len(self.values)), varying_values)
+            self.next_state = self._build_state()
+        else:
+            self.next_state = None
         self.current_id += 1
 
         return True
+    
+    # yields, one at a time, the states whose id is in [start_from, end_at). If the state space can be indexed
+    # then the states that come before start_from are not even built
+    def generate(self, start_from=0, end_at=None):
+        size = self.size()
+        if size is not None:
+            if end_at is None or end_at > size:
+                end_at = size
+            for i in range(start_from, end_at):
+                yield self.get_state(i)
+        else:
+            self.reset()
+            while end_at is None or self.current_id < end_at:
+                if not self.set_next(expand=self.current_id >= start_from):
+                    break
+                if self.current_id > start_from:
+                    yield self.next_state
+
+
+# a token bucket that limits the rate at which jobs are launched: up to burst jobs can be launched at once, 
+# after which jobs are launched at most rate times per second
+class RateLimiter(object):
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = monotonic()
+        
+    def wait(self):
+        if self.rate <= 0:
+            return
+        
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1
+            self.last = monotonic()
+        self.tokens -= 1
+
+
+class AdmissionControl(object):
+    # blocks new launches as long as the load average is larger than max_load or the available memory (in MB) or the 
+    # free space on the disk containing directory (in MB) are smaller than min_free_memory or min_free_disk. None 
+    # values disable the corresponding check
+    def __init__(self, max_load, min_free_memory, min_free_disk, directory, interval):
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.min_free_disk = min_free_disk
+        self.directory = directory
+        self.interval = interval
+        # jobs that are about to start wait one at a time, so that they do not all start as soon as the host is less busy
+        self.lock = threading.Lock()
+        
+    # returns the threshold that has been crossed and a description of the reason why launches should be paused, or 
+    # None if a job can be launched
+    def check(self):
+        if self.max_load is not None:
+            load = os.getloadavg()[0]
+            if load > self.max_load:
+                return "MaxLoad", "the load average is %.2f (MaxLoad = %g)" % (load, self.max_load)
+            
+        if self.min_free_memory is not None:
+            memory = Host.memory("MemAvailable")
+            if memory is not None and memory < self.min_free_memory:
+                return "MinFreeMemory", "the available memory is %.0f MB (MinFreeMemory = %g MB)" % (memory, self.min_free_memory)
+            
+        if self.min_free_disk is not None:
+            vfs = os.statvfs(self.directory)
+            disk = vfs.f_bavail * vfs.f_frsize / (1024. * 1024.)
+            if disk < self.min_free_disk:
+                return "MinFreeDisk", "the free disk space is %.0f MB (MinFreeDisk = %g MB)" % (disk, self.min_free_disk)
+            
+        return None
+        
+    def wait(self):
+        with self.lock:
+            for interval in self.pauses():
+                sleep(interval)
+        
+    # yields the number of seconds to wait for before checking again, for as long as launches should be paused, so 
+    # that the waiting can be done either by blocking a thread (see wait) or on an event loop (see AsyncioEngine)
+    def pauses(self):
+        reason = self.check()
+        if reason is None:
+            return
+        
+        start = monotonic()
+        Logger.log("Pausing job launches: %s" % reason[1], Logger.INFO)
+        while reason is not None:
+            yield self.interval
+            new_reason = self.check()
+            # we log only when the threshold changes, so as not to flood the output
+            if new_reason is not None and new_reason[0] != reason[0]:
+                Logger.log("Job launches are still paused: %s" % new_reason[1], Logger.INFO)
+            reason = new_reason
+        Logger.log("Resuming job launches after %.1f seconds" % (monotonic() - start), Logger.INFO)
+
+
+class Manifest(object):
+    # a file describing the states of a run, so that its chunks can be run independently (e.g. by the tasks of a SLURM 
+    # or PBS array job) with "pyrla --manifest file --run-index K". The first line contains the configuration of the 
+    # run and the keys shared by all the states, while the K-th following line contains the other keys of the states 
+    # of the K-th chunk
+    SCRIPTS = {
+        "slurm" : "#!/bin/bash\n#SBATCH --array=0-%(last)d\n\n%(command)s --run-index $SLURM_ARRAY_TASK_ID\n",
+        "pbs" : "#!/bin/bash\n#PBS -J 0-%(last)d\n\ncd \"$PBS_O_WORKDIR\"\n%(command)s --run-index $PBS_ARRAY_INDEX\n"
+    }
+    
+    # batches is a function that returns a new iterator over the chunks at each call. Returns the number of chunks
+    def write(filename, batches, config):
+        common = None
+        for batch in batches():
+            for state in batch:
+                if common is None:
+                    common = dict(state)
+                else:
+                    common = dict((k, v) for k, v in common.items() if k in state and state[k] == v)
+        if common is None:
+            common = {}
+                    
+        num_chunks = 0
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            f.write(json.dumps({"config" : config, "common" : common}) + "\n")
+            for batch in batches():
+                chunk = [dict((k, v) for k, v in state.items() if k not in common) for state in batch]
+                f.write(json.dumps(chunk) + "\n")
+                num_chunks += 1
+        os.replace(tmp_filename, filename)
+        
+        # an array job can't be empty
+        if num_chunks == 0:
+            Logger.log("There are no jobs to run, the array job scripts have not been written", Logger.WARNING)
+            return num_chunks
+        
+        # pyrla is run by the same interpreter, since the script may not be executable
+        command = " ".join(shlex.quote(arg) for arg in (sys.executable, os.path.abspath(sys.argv[0]), "--manifest", os.path.abspath(filename)))
+        for scheduler, script in Manifest.SCRIPTS.items():
+            with open("%s.%s" % (filename, scheduler), "w") as f:
+                f.write(script % {"last" : num_chunks - 1, "command" : command})
+        
+        return num_chunks
+    write = staticmethod(write)
+    
+    # returns the configuration of the run and the states of the index-th chunk, or None if there is no such chunk
+    def read(filename, index):
+        with open(filename) as f:
+            header = json.loads(f.readline())
+            for i, line in enumerate(f):
+                if i == index:
+                    chunk = [dict(header["common"], **state) for state in json.loads(line)]
+                    return header["config"], chunk
+        return header["config"], None
+    read = staticmethod(read)
+    
+    # stages and runs the index-th chunk. Returns True if all its states completed successfully
+    def run(filename, index):
+        try:
+            config, batch = Manifest.read(filename, index)
+        except (OSError, ValueError) as e:
+            Logger.log("Can't read the manifest '%s' (error: %s)" % (filename, e), Logger.CRITICAL)
+            exit(1)
+        if batch is None:
+            Logger.log("The manifest '%s' does not contain the chunk %d" % (filename, index), Logger.CRITICAL)
+            exit(1)
+            
+        os.chdir(config["cwd"])
+        launcher = Launcher(config["input"])
+        launcher.configure_jobs()
+        
+        job = Job(index, config["safe"])
+        job.journal = MemoryJournal()
+        ThreadEngine(1, config["safe"]).run_batch(job, batch)
+        
+        if launcher.journal_file is not None:
+            journal = Journal(launcher.journal_file)
+            journal.write_all(job.journal)
+            journal.close()
+        
+        completed = set(r["job_id"] for r in job.journal if r["event"] == "end" and r["status"] in ("done", "unchanged"))
+        return all(int(state["JOB_ID"]) in completed for state in batch)
+    run = staticmethod(run)
+
+
+class Sharder(object):
+    # assigns each state to one of num_shards shards. The assignment depends only on the input file, so that the states 
+    # can be split among several pyrla instances (e.g. running on different nodes) without any coordination
+    POLICIES = ("round-robin", "hash", "cost")
+    
+    def __init__(self, num_shards, policy):
+        self.num_shards = num_shards
+        self.policy = policy
+        # used by the cost policy, maps each JOB_ID to its shard
+        self.assignment = None
+        
+    # the estimated cost of a state is given by JobCost or, if it is not set, by JobCores
+    def cost(state):
+        for key in ("JobCost", "JobCores"):
+            if key in state:
+                try:
+                    return float(state[key])
+                except ValueError:
+                    Logger.log("Invalid value '%s' for the key %s of the job with JOB_ID %s, its cost will be set to 1" % (state[key], key, state["JOB_ID"]), Logger.WARNING)
+                    break
+        return 1.
+    cost = staticmethod(cost)
+    
+    # the cost policy needs to know the cost of all the states before any of them can be assigned
+    def prepare(self, states):
+        if self.policy != "cost":
+            return
+        
+        costs = sorted(((Sharder.cost(state), int(state["JOB_ID"])) for state in states), key=lambda c: (-c[0], c[1]))
+        # the most expensive states are assigned first, each to the shard with the smallest total cost
+        shards = [(0., i) for i in range(self.num_shards)]
+        self.assignment = {}
+        for cost, job_id in costs:
+            load, i = heapq.heappop(shards)
+            self.assignment[job_id] = i
+            heapq.heappush(shards, (load + cost, i))
+    
+    def shard_of(self, state):
+        if self.policy == "round-robin":
+            return int(state["JOB_ID"]) % self.num_shards
+        elif self.policy == "hash":
+            # the keys set by pyrla are left out: JOB_ID, so that the shard of a state does not change if other states are 
+            # added or removed, and BASE_DIR, since it depends on the directory pyrla is launched from, which may differ 
+            # from node to node. For the same reason, the base directory is replaced by a placeholder in the values of 
+            # the other keys
+            base_dir = state["BASE_DIR"]
+            if len(base_dir) > 1:
+                state = dict((k, str(v).replace(base_dir, "$(BASE_DIR)")) for k, v in state.items())
+            return int(Job.state_hasher(state, KeyValueDict.PROTECTED_KEYS).hexdigest(), 16) % self.num_shards
+        else:
+            job_id = int(state["JOB_ID"])
+            if job_id not in self.assignment:
+                Logger.log("The job with JOB_ID %d has not been assigned to any shard" % job_id, Logger.CRITICAL)
+                exit(1)
+            return self.assignment[job_id]
 
 
 class Launcher(object):
+    ENGINES = {"Threads" : ThreadEngine, "Asyncio" : AsyncioEngine}
+    
     def __init__(self, inp):
-        self.states = []
         self.num_states = 0
 
         # default values
         self.max_jobs = 0
         self.waiting_time = 2.0
+        # if set, jobs are launched as soon as there is a free slot (subject to the rate limit) and waiting_time is ignored
+        self.launch_rate = None
+        self.launch_burst = 1
 
         self.copy_from = None
-        self.copy_from_lines = None
+        self.copy_from_index = None
+        self.copy_from_template = None
+        
+        self.jinja_undefined = "Default"
+        self.jinja_filters = None
 
         self.times = 1
-
+        self.batch_size = 1
+        self.engine = "Threads"
+        # maps the resources requested by the jobs to their availability on the host. If empty, no ResourceScheduler is used
+        self.capacity = {}
+        self.scheduler_policy = "Backfill"
+        self.scheduler_window = 100
+        
+        # thresholds used by the AdmissionControl (None means that the check is disabled)
+        self.max_load = None
+        self.min_free_memory = None
+        self.min_free_disk = None
+        self.admission_interval = 5.0
+        
+        self.bash_cache_file = None
+        self.bash_prefetch = 0
+        
+        self.journal_file = None
+        # if not None, only the states assigned to the shard_index-th shard by the Sharder are run
+        self.sharder = None
+        self.shard_index = 0
+        # when resuming, maps the (JOB_ID, state hash) pairs to the number of times the corresponding jobs completed
+        self.completed = None
+
+        self.input_file = inp
         self.inp_parser = KeyValueDict(inp)
         self.inp_parser.parse()
 
@@ -815,18 +2797,50 @@ class Launcher(object):
             exit(1)
 
         with open(self.copy_from) as f:
-            self.copy_from_lines = f.readlines()
+            copy_from_lines = f.readlines()
+        self.copy_from_index = CopyFromIndex(copy_from_lines)
 
         if self.inp_parser["InputType"]() == "Jinja2":
-            j_env = jinja2.Environment()
+            j_env = self.get_jinja_environment()
             try:
-                j_env.from_string("\n".join(self.copy_from_lines))
+                self.copy_from_template = j_env.from_string("".join(copy_from_lines))
             except jinja2.exceptions.TemplateSyntaxError as e:
                 Logger.log("jinja2 raised the following syntax error: '%s' at line %d" % (e.message, e.lineno), Logger.CRITICAL)
                 exit(1)
             except jinja2.exceptions.TemplateError as e:
-                Logger.log("jinja2raised the following error: '%s'" % e.message, Logger.CRITICAL)
+                Logger.log("jinja2 raised the following error: '%s'" % e.message, Logger.CRITICAL)
+                exit(1)
+                
+    def get_jinja_environment(self):
+        undefined_types = {
+            "Default" : jinja2.Undefined,
+            "Strict" : jinja2.StrictUndefined,
+            "Debug" : jinja2.DebugUndefined,
+            "Chainable" : jinja2.ChainableUndefined
+            }
+        if self.jinja_undefined not in undefined_types:
+            Logger.log("Invalid JinjaUndefined. The supported values are %s" % ", ".join(undefined_types.keys()), Logger.CRITICAL)
+            exit(1)
+            
+        j_env = jinja2.Environment(undefined=undefined_types[self.jinja_undefined], autoescape=False)
+        
+        if self.jinja_filters is not None:
+            # all the public functions defined in the file are made available as filters
+            spec = importlib.util.spec_from_file_location("pyrla_jinja_filters", self.jinja_filters)
+            if spec is None:
+                Logger.log("JinjaFilters file '%s' is not a python file" % self.jinja_filters, Logger.CRITICAL)
+                exit(1)
+            module = importlib.util.module_from_spec(spec)
+            try:
+                spec.loader.exec_module(module)
+            except Exception as e:
+                Logger.log("Can't load the JinjaFilters file '%s' (error: %s)" % (self.jinja_filters, e), Logger.CRITICAL)
                 exit(1)
+            for name, obj in vars(module).items():
+                if callable(obj) and not name.startswith("_") and getattr(obj, "__module__", None) == module.__name__:
+                    j_env.filters[name] = obj
+                    
+        return j_env
 
     def get_global_options(self):
         if "ContemporaryJobs" in self.inp_parser:
@@ -840,17 +2854,146 @@ class Launcher(object):
 
         if "WaitingTime" in self.inp_parser:
             self.waiting_time = float(self.inp_parser.pop("WaitingTime")())
+            if "LaunchRate" in self.inp_parser:
+                Logger.log("Both WaitingTime and LaunchRate are set: WaitingTime will be ignored", Logger.WARNING)
+            
+        if "LaunchRate" in self.inp_parser:
+            self.launch_rate = float(self.inp_parser.pop("LaunchRate")())
+            
+        if "LaunchBurst" in self.inp_parser:
+            self.launch_burst = int(self.inp_parser.pop("LaunchBurst")())
+            
+        if "BatchSize" in self.inp_parser:
+            self.batch_size = int(self.inp_parser.pop("BatchSize")())
+            if self.batch_size < 1:
+                Logger.log("BatchSize should be larger than 0", Logger.CRITICAL)
+                exit(1)
+            
+        if "Engine" in self.inp_parser:
+            self.engine = self.inp_parser.pop("Engine")().capitalize()
+            if self.engine not in Launcher.ENGINES:
+                Logger.log("Engine should be one of %s" % ", ".join(sorted(Launcher.ENGINES)), Logger.CRITICAL)
+                exit(1)
+            
+        for job_key, host_key in ResourceScheduler.RESOURCES:
+            if host_key in self.inp_parser:
+                value = self.inp_parser.pop(host_key)()
+                self.capacity[job_key] = ResourceScheduler.parse_memory(value) if job_key == "JobMemory" else float(value)
+            elif job_key in self.inp_parser:
+                if job_key == "JobCores":
+                    self.capacity[job_key] = len(Host.cores())
+                elif job_key == "JobMemory":
+                    self.capacity[job_key] = Host.memory("MemTotal")
+                    if self.capacity[job_key] is None:
+                        Logger.log("Can't detect the amount of memory of the host, JobMemory will be ignored (use HostMemory to set it)", Logger.WARNING)
+                else:
+                    self.capacity[job_key] = None
+                    Logger.log("JobSlots is set but HostSlots is not, JobSlots will be ignored", Logger.WARNING)
+                    
+        if "SchedulerPolicy" in self.inp_parser:
+            self.scheduler_policy = self.inp_parser.pop("SchedulerPolicy")().capitalize()
+            if self.scheduler_policy not in ResourceScheduler.POLICIES:
+                Logger.log("SchedulerPolicy should be one of %s" % ", ".join(ResourceScheduler.POLICIES), Logger.CRITICAL)
+                exit(1)
+            if len(self.capacity) == 0:
+                self.capacity["JobCores"] = len(Host.cores())
+                
+        if "CpuAffinity" in self.inp_parser:
+            affinity = self.inp_parser.pop("CpuAffinity")().capitalize()
+            if affinity not in ("None", "Cores", "Numa"):
+                Logger.log("CpuAffinity should be one of None, Cores or Numa", Logger.CRITICAL)
+                exit(1)
+            if affinity != "None":
+                if hasattr(os, "sched_setaffinity"):
+                    Job.core_pool = CorePool(affinity == "Numa")
+                else:
+                    Logger.log("CPU affinity is not supported on this platform, CpuAffinity will be ignored", Logger.WARNING)
+            
+        if "Incremental" in self.inp_parser:
+            Job.incremental = self.inp_parser.pop("Incremental").raw_value.capitalize() == "True"
+            
+        if "JournalFile" in self.inp_parser:
+            self.journal_file = self.inp_parser.pop("JournalFile").raw_value
+            
+        if "MaxLoad" in self.inp_parser:
+            self.max_load = float(self.inp_parser.pop("MaxLoad")())
+            
+        if "MinFreeMemory" in self.inp_parser:
+            self.min_free_memory = ResourceScheduler.parse_memory(self.inp_parser.pop("MinFreeMemory")())
+            
+        if "MinFreeDisk" in self.inp_parser:
+            self.min_free_disk = ResourceScheduler.parse_memory(self.inp_parser.pop("MinFreeDisk")())
+            
+        if "AdmissionInterval" in self.inp_parser:
+            self.admission_interval = float(self.inp_parser.pop("AdmissionInterval")())
+            
+        if "SchedulerWindow" in self.inp_parser:
+            self.scheduler_window = int(self.inp_parser.pop("SchedulerWindow")())
+            
+        if "JinjaUndefined" in self.inp_parser:
+            self.jinja_undefined = self.inp_parser.pop("JinjaUndefined")().capitalize()
+            
+        if "JinjaFilters" in self.inp_parser:
+            self.jinja_filters = self.inp_parser.pop("JinjaFilters")()
+            
+        if "CopyThreads" in self.inp_parser:
+            copy_threads = int(self.inp_parser.pop("CopyThreads")())
+            if copy_threads > 0:
+                ObjectCopier.executor = ThreadPoolExecutor(max_workers=copy_threads)
+            
+        if "BashCache" in self.inp_parser:
+            BashKey.cache_enabled = self.inp_parser.pop("BashCache").raw_value.capitalize() == "True"
+            
+        if "BashCacheFile" in self.inp_parser:
+            self.bash_cache_file = self.inp_parser.pop("BashCacheFile").raw_value
+            if BashKey.cache_enabled:
+                BashKey.load_cache(self.bash_cache_file)
+            
+        if "BashNoCache" in self.inp_parser:
+            for k in self.inp_parser.pop("BashNoCache").raw_value.split():
+                if k not in self.inp_parser or not isinstance(self.inp_parser[k], BashKey):
+                    Logger.log("The key '%s' listed in BashNoCache is not a bash key" % k, Logger.WARNING)
+                else:
+                    # the command will be run anew for each state
+                    self.inp_parser[k].volatile = True
+                    
+        if "UseShell" in self.inp_parser:
+            Command.set_shell_mode(self.inp_parser.pop("UseShell").raw_value.split(), True, self.inp_parser, "UseShell")
+            
+        if "NoShell" in self.inp_parser:
+            Command.set_shell_mode(self.inp_parser.pop("NoShell").raw_value.split(), False, self.inp_parser, "NoShell")
+            
+        if "BashPrefetch" in self.inp_parser:
+            self.bash_prefetch = int(self.inp_parser.pop("BashPrefetch")())
 
     def print_run_info(self, state_factory, complete):
         basekeys = state_factory.get_constant_keys()
         my_format = "\t%s: %s"
         # the JOB_ID key is different from any other key, as it is considered to be immutable by pyrla but it is not
-        formatted_basekeys = [my_format % (k.key, k.value) for k in basekeys if k.key != "JOB_ID"]
+        formatted_basekeys = [my_format % (k.key, k.value) for k in basekeys if k.key not in ("JOB_ID", "JOB_CORES")]
 
         print("\nRUN INFO:")
         print("Number of processes: %d" % self.num_states)
         print("Contemporary processes: %d" % self.max_jobs)
-        print("Waiting time between job launches: %f" % self.waiting_time)
+        if self.launch_rate is None:
+            print("Waiting time between job launches: %f" % self.waiting_time)
+        elif self.launch_rate > 0:
+            print("Jobs are launched as soon as a slot is free, at most %f per second (in bursts of up to %d)" % (self.launch_rate, self.launch_burst))
+        else:
+            print("Jobs are launched as soon as a slot is free")
+        if self.engine != "Threads":
+            print("Jobs are run by the %s engine" % self.engine)
+        if Job.core_pool is not None:
+            print("Each job is pinned to its own cores, taken from %d NUMA node(s)" % len(Job.core_pool.nodes))
+        if len(self.capacity) > 0:
+            available = ", ".join("%s = %s" % (k, "unlimited" if v is None else "%g" % v) for k, v in sorted(self.capacity.items()))
+            print("Jobs are scheduled according to their requirements with the %s policy (available resources: %s)" % (self.scheduler_policy, available))
+        if Job.incremental:
+            print("Jobs that already completed with the same keys, CopyTo file and CopyObjects will be skipped")
+        if self.admission_enabled():
+            print("Job launches are paused when the system is too busy (checked every %g seconds)" % self.admission_interval)
+        if self.batch_size > 1:
+            print("Jobs are run in batches of up to %d states" % self.batch_size)
         if self.times > 1:
             print("Each job will be repeated %d times" % self.times)
         if self.copy_from != None:
@@ -858,57 +3001,255 @@ class Launcher(object):
         print("\nKEYS WITH FIXED VALUES")
         print("\n".join(formatted_basekeys))
         
+        if self.sharder is not None:
+            self.print_shard_info(state_factory)
+        
         if complete:
-            for i in range(len(self.states)):
+            for i, state in enumerate(state_factory.generate()):
+                if self.sharder is not None and self.sharder.shard_of(state) != self.shard_index:
+                    continue
                 print("\nJOB %d" % i)
-                for k, v in self.states[i].items():
+                for k, v in state.items():
                     to_print = my_format % (k, v)
-                    if to_print not in formatted_basekeys:
+                    if to_print not in formatted_basekeys and k != "JOB_CORES":
                         print(to_print)
 
+    # prints the number of states and the total cost of each shard and checks that each state belongs to exactly one shard
+    def print_shard_info(self, state_factory):
+        num_shards = self.sharder.num_shards
+        counts = [0] * num_shards
+        costs = [0.] * num_shards
+        # the shard of each state, indexed by JOB_ID
+        assignment = []
+        for state in state_factory.generate():
+            i = self.sharder.shard_of(state)
+            assignment.append(i)
+            if not 0 <= i < num_shards:
+                Logger.log("The job with JOB_ID %s has been assigned to the invalid shard %d" % (state["JOB_ID"], i), Logger.CRITICAL)
+                exit(1)
+            counts[i] += 1
+            costs[i] += Sharder.cost(state)
+            
+        print("\nSHARDS (%s policy, this is shard %d)" % (self.sharder.policy, self.shard_index))
+        for i in range(num_shards):
+            print("\tShard %d: %d jobs, total cost %g" % (i, counts[i], costs[i]))
+            
+        # each pyrla instance works out its own shard from scratch: we do the same once more and check that each state 
+        # is assigned to the same shard again, which would not be the case if, for instance, the hash policy were used 
+        # with keys whose values are random numbers
+        sharder = Sharder(num_shards, self.sharder.policy)
+        sharder.prepare(state_factory.generate())
+        num_states = 0
+        wrong = []
+        for state in state_factory.generate():
+            job_id = int(state["JOB_ID"])
+            if job_id >= len(assignment) or sharder.shard_of(state) != assignment[job_id]:
+                wrong.append(job_id)
+            num_states += 1
+        if len(wrong) == 0 and num_states == len(assignment):
+            print("Each of the %d states belongs to exactly one shard" % num_states)
+        else:
+            Logger.log("%d states are assigned to different shards when the shards are computed independently (e.g. the job with JOB_ID %d)" % (max(len(wrong), 1), wrong[0] if wrong else num_states), Logger.CRITICAL)
+            exit(1)
+
+    # sets the options shared by all the jobs
+    def configure_jobs(self):
+        if self.copy_from is not None:
+            Job.copy_from_index = self.copy_from_index
+            Job.copy_from_template = self.copy_from_template
+            
+        if self.admission_enabled():
+            Job.admission = AdmissionControl(self.max_load, self.min_free_memory, self.min_free_disk, os.getcwd(), self.admission_interval)
+
+    def admission_enabled(self):
+        return self.max_load is not None or self.min_free_memory is not None or self.min_free_disk is not None
+
     def launch(self, opts):
         state_factory = StateFactory(list(self.inp_parser.values()), self.inp_parser.modifiers)
+        if self.bash_prefetch > 0:
+            state_factory.prefetch_bash_commands(self.bash_prefetch)
+
+        # states are generated lazily: their total number is known in advance only if there are no 
+        # RunConditions and the number of values of each key does not depend on the other keys. Otherwise
+        # we count them by expanding only the keys the RunConditions depend on
+        num_states = state_factory.count(opts['max_states'])
+        if num_states > opts['max_states']:
+            Logger.log("The number of states exceeds the maximum number %d" % opts['max_states'], Logger.CRITICAL)
+            exit(1)
 
-        while state_factory.set_next() != False:
-            self.states.append(state_factory.next_state)
-            self.num_states += 1
-
-            if self.num_states > opts['max_states']:
-                Logger.log("The number of states exceeds the maximum number %d" % opts['max_states'], Logger.CRITICAL)
-                exit(1)
-                
-        if self.max_jobs > self.num_states or self.max_jobs == 0:
-            self.max_jobs = self.num_states
+        end_at = None
+        if opts['end_after'] is not None:
+            end_at = opts['start_from'] + opts['end_after']
+        if end_at is None or end_at > opts['max_states']:
+            end_at = opts['max_states']
+            
+        if opts['shard'] is not None:
+            self.shard_index, num_shards = opts['shard']
+            self.sharder = Sharder(num_shards, opts['shard_policy'])
+            if opts['dry_run'] or opts['summarise']:
+                self.sharder.prepare(state_factory.generate())
+            else:
+                self.sharder.prepare(state_factory.generate(opts['start_from'], end_at))
+
+        if opts['export_manifest'] is not None:
+            config = {"input" : os.path.abspath(self.input_file), "cwd" : os.getcwd(), "safe" : opts['safe']}
+            batches = lambda: self.batches(self.states(state_factory, opts['start_from'], end_at))
+            num_chunks = Manifest.write(opts['export_manifest'], batches, config)
+            Logger.log("%d chunks have been written to the manifest '%s'" % (num_chunks, opts['export_manifest']), Logger.INFO)
+            self.save_bash_cache()
+            return
 
         if opts['dry_run'] or opts['summarise']:
+            if self.sharder is None:
+                self.num_states = num_states
+            else:
+                self.num_states = sum(1 for state in state_factory.generate() if self.sharder.shard_of(state) == self.shard_index)
+            if self.max_jobs > self.num_states or self.max_jobs == 0:
+                self.max_jobs = self.num_states
             self.print_run_info(state_factory, opts['dry_run'])
+            self.save_bash_cache()
             return
         
         if opts['wait'] > 0:
             import time
             time.sleep(opts['wait'])
 
-        if self.copy_from is not None:
-            Job.copy_from_lines = self.copy_from_lines
+        self.configure_jobs()
 
-        for i in range(self.max_jobs):
-            j = Job(i, opts['safe'])
-            j.setDaemon(True)
-            j.start()
-
-        end_at = self.num_states
-        if opts['end_after'] is not None:
-            end_at = opts['start_from'] + opts['end_after']
-            if end_at > self.num_states:
-                end_at = self.num_states
-
-        for j in range(self.times):
-            for i in range(opts['start_from'], end_at):
-                Logger.log("State n.%d: " % i + str(self.states[i]), Logger.DEBUG)
-                Job.queue.put(self.states[i], block=True)
-                sleep(self.waiting_time)
+        if self.journal_file is not None:
+            if opts['resume']:
+                self.completed = Journal.completed(self.journal_file)
+            Job.journal = Journal(self.journal_file)
+        elif opts['resume']:
+            Logger.log("Resuming a run requires a JournalFile", Logger.CRITICAL)
+            exit(1)
+            
+        try:
+            if opts['stage'] > 0 or opts['prepare_only']:
+                self.stage(state_factory, opts['start_from'], end_at, opts['stage'] if opts['stage'] > 0 else 4, opts['safe'], opts['prepare_only'])
+                if opts['prepare_only']:
+                    self.save_bash_cache()
+                    return
 
-        Job.queue.join()
+            if self.launch_rate is not None:
+                rate_limiter = RateLimiter(self.launch_rate, self.launch_burst)
+            
+            # the resources of the hosts of the workers are accounted for by the workers themselves
+            if opts['coordinator'] is not None:
+                engine = CoordinatorEngine(opts['coordinator'], self.input_file, opts['safe'])
+            else:
+                engine = Launcher.ENGINES[self.engine](self.max_jobs, opts['safe'])
+                if len(self.capacity) > 0:
+                    engine = ResourceScheduler(engine, self.capacity, self.scheduler_policy, self.scheduler_window)
+            for j in range(self.times):
+                for batch in self.batches(self.states(state_factory, opts['start_from'], end_at, j)):
+                    for state in batch:
+                        Logger.log("State n.%s: " % state["JOB_ID"] + str(state), Logger.DEBUG)
+                    if self.launch_rate is None:
+                        engine.submit(batch, j == 0)
+                        sleep(self.waiting_time)
+                    else:
+                        # submit blocks until a slot is free, so that jobs are launched as soon as possible
+                        rate_limiter.wait()
+                        engine.submit(batch, j == 0)
+
+            engine.join()
+        finally:
+            if Job.journal is not None:
+                Job.journal.close()
+        self.save_bash_cache()
+        
+    # generates the states that should be run in the given round (see Times). When resuming, the states that 
+    # already completed are skipped
+    def states(self, state_factory, start_from, end_at, round_number=0):
+        skipped = 0
+        for state in state_factory.generate(start_from, end_at):
+            if self.sharder is not None and self.sharder.shard_of(state) != self.shard_index:
+                continue
+            if self.completed is not None and self.completed[(int(state["JOB_ID"]), Job.state_hash(state))] > round_number:
+                skipped += 1
+                continue
+            yield state
+            
+        if skipped > 0:
+            Logger.log("%d jobs have already completed and have been skipped" % skipped, Logger.INFO)
+        
+    # groups consecutive states in lists of at most batch_size states
+    def batches(self, states):
+        batch = []
+        copy_to_paths = set()
+        for state in states:
+            # states that write the same CopyTo file should not end up in the same batch, since their files would 
+            # be written one on top of the other before the batch is run
+            path = self._copy_to_path(state) if self.batch_size > 1 else None
+            if len(batch) == self.batch_size or (path is not None and path in copy_to_paths):
+                yield batch
+                batch = []
+                copy_to_paths = set()
+                
+            batch.append(state)
+            copy_to_paths.add(path)
+            
+        if len(batch) > 0:
+            yield batch
+    
+    def _copy_to_path(self, state):
+        if "CopyFrom" not in state:
+            return None
+        
+        working_dir = os.path.join(os.getcwd(), state["DirectoryStructure"]) if "DirectoryStructure" in state else os.getcwd()
+        name = state["CopyTo"] if "CopyTo" in state else state["CopyFrom"]
+        return os.path.normpath(os.path.join(working_dir, name))
+    
+    def _stage_state(self, state, safe, persist):
+        job = Job(int(state["JOB_ID"]), safe)
+        job.state = state
+        try:
+            # up-to-date states (see Incremental) are not staged: they will be skipped when their turn comes
+            copy_to_contents = None
+            if Job.incremental:
+                copy_to_contents = job.render_copy_to()
+                if job.is_up_to_date(job.compute_fingerprint(copy_to_contents)):
+                    return
+            job.stage(copy_to_contents)
+            if persist:
+                with open(os.path.join(job.working_dir, Job.STAGED_PREFIX + str(state["JOB_ID"])), "w") as f:
+                    f.write(Job.state_hash(state) + "\n")
+            Job.staged[state["JOB_ID"]] = job.working_dir
+        except Exception as e:
+            Logger.log(e, Logger.WARNING if isinstance(e, Job.SafeError) else Logger.ERROR)
+            Job.staged[state["JOB_ID"]] = None
+    
+    # creates the working directories, CopyTo files and CopyObjects of the jobs in advance, using num_threads threads. 
+    # If persist is True, the staged jobs are marked as such (see Job.was_prepared)
+    def stage(self, state_factory, start_from, end_at, num_threads, safe, persist=False):
+        start = monotonic()
+        
+        # states that write the same CopyTo file cannot be staged in advance, since each of them should find 
+        # its own version of the file when it runs. These are staged right before they run, as usual
+        targets = collections.Counter(self._copy_to_path(state) for state in state_factory.generate(start_from, end_at))
+        
+        num_lazy = 0
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            pending = set()
+            for state in self.states(state_factory, start_from, end_at):
+                path = self._copy_to_path(state)
+                if path is not None and targets[path] > 1:
+                    num_lazy += 1
+                    continue
+                
+                pending.add(executor.submit(self._stage_state, state, safe, persist))
+                # we do not want to keep too many states in memory
+                if len(pending) >= 2 * num_threads:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    
+        Logger.log("Staged %d jobs in %.3f seconds" % (len(Job.staged), monotonic() - start), Logger.INFO)
+        if num_lazy > 0:
+            Logger.log("%d jobs share their CopyTo file with other jobs and will be staged right before they run" % num_lazy, Logger.INFO)
+    
+    def save_bash_cache(self):
+        if self.bash_cache_file is not None and BashKey.cache_enabled:
+            BashKey.save_cache(self.bash_cache_file)
 
 
 def main():
@@ -916,7 +3257,11 @@ def main():
         print("USAGE:")
         print("\t%s input [-d|--debug] [-h|--help] [-v|--version]" % sys.argv[0])
         print("\t[-r|--dry-run] [-s|--safe] [--max-states N] [--start-from N] [--end-after N]")
-        print("\t[-S\--summarise] [-w\--wait seconds]")
+        print("\t[-S\--summarise] [-w\--wait seconds] [--stage N] [--prepare-only] [--resume]")
+        print("\t[--shard i/N] [--shard-policy round-robin|hash|cost] [--coordinator address]")
+        print("\t[--export-manifest file]")
+        print("\t%s --worker address [--worker-jobs N] [-d|--debug]" % sys.argv[0])
+        print("\t%s --manifest file --run-index K [-d|--debug]" % sys.argv[0])
         exit(1)
 
     def print_version():
@@ -928,7 +3273,9 @@ def main():
         
     def parse_options(command_line_args):
         shortArgs = 'dhvrsSw:'
-        longArgs = ['debug', 'help', 'version', 'dry-run', 'safe', 'max-states=', 'start-from=', 'end-after=', 'summarise', 'wait=']
+        longArgs = ['debug', 'help', 'version', 'dry-run', 'safe', 'max-states=', 'start-from=', 'end-after=', 'summarise', 'wait=',
+                    'stage=', 'prepare-only', 'resume', 'shard=', 'shard-policy=', 'coordinator=', 'worker=', 'worker-jobs=',
+                    'export-manifest=', 'manifest=', 'run-index=']
         # by default we do not want to output messages marked with the Logger.DEBUG flag
         Logger.debug_level = 1
         opts = {
@@ -938,18 +3285,23 @@ def main():
                 'max_states' : MAX_STATES,
                 'start_from' : 0,
                 'end_after' : None,
-                'wait' : 0
+                'wait' : 0,
+                'stage' : 0,
+                'prepare_only' : False,
+                'resume' : False,
+                'shard' : None,
+                'shard_policy' : "round-robin",
+                'coordinator' : None,
+                'worker' : None,
+                'worker_jobs' : 1,
+                'export_manifest' : None,
+                'manifest' : None,
+                'run_index' : None
                 }
     
         import getopt
         args, files = getopt.gnu_getopt(command_line_args, shortArgs, longArgs)
         
-        if len(files) == 0:
-            raise Exception("Mandatory input file missing")
-        
-        if len(files) > 1:
-            raise Exception("There should be a single input file, found %d" % len(files))
-        
         for k in args:
             if k[0] == '-d' or k[0] == '--debug': 
                 Logger.debug_level = 0
@@ -971,6 +3323,49 @@ def main():
                 opts['end_after'] = int(k[1])
             if k[0] == '--max-states': 
                 opts['max_states'] = int(k[1])
+            if k[0] == '--stage':
+                opts['stage'] = int(k[1])
+            if k[0] == '--prepare-only':
+                opts['prepare_only'] = True
+            if k[0] == '--resume':
+                opts['resume'] = True
+            if k[0] == '--shard':
+                index, _, num_shards = k[1].partition("/")
+                opts['shard'] = (int(index), int(num_shards))
+                if not 0 <= opts['shard'][0] < opts['shard'][1]:
+                    raise Exception("The shard index should be between 0 and N - 1, found '%s'" % k[1])
+            if k[0] == '--shard-policy':
+                opts['shard_policy'] = k[1].lower()
+                if opts['shard_policy'] not in Sharder.POLICIES:
+                    raise Exception("The shard policy should be one of %s, found '%s'" % (", ".join(Sharder.POLICIES), k[1]))
+            if k[0] == '--coordinator':
+                opts['coordinator'] = k[1]
+            if k[0] == '--worker':
+                opts['worker'] = k[1]
+            if k[0] == '--worker-jobs':
+                opts['worker_jobs'] = int(k[1])
+            if k[0] == '--export-manifest':
+                opts['export_manifest'] = k[1]
+            if k[0] == '--manifest':
+                opts['manifest'] = k[1]
+            if k[0] == '--run-index':
+                opts['run_index'] = int(k[1])
+                
+        # workers take their input file from the coordinator
+        if opts['worker'] is not None:
+            return opts, None
+        
+        # the tasks of array jobs take everything they need from the manifest
+        if opts['run_index'] is not None:
+            if opts['manifest'] is None:
+                raise Exception("--run-index requires a manifest (--manifest file)")
+            return opts, None
+        
+        if len(files) == 0:
+            raise Exception("Mandatory input file missing")
+        
+        if len(files) > 1:
+            raise Exception("There should be a single input file, found %d" % len(files))
                 
         if opts['dry_run'] and opts['summarise']:
             raise Exception("Summarise (-S/--summarise) and dry-run (-r/--dry-run) are incompatible")
@@ -982,6 +3377,19 @@ def main():
         Logger.log(e, Logger.ERROR)
         print_usage()
 
+    if opts['worker'] is not None:
+        Worker(opts['worker'], opts['worker_jobs']).run()
+        return
+    
+    if opts['run_index'] is not None:
+        if not Manifest.run(opts['manifest'], opts['run_index']):
+            exit(1)
+        return
+
+    # the threads running the jobs are not waited for if pyrla is stopped, hence we clean up after them at exit
+    atexit.register(Job.remove_status_files)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
     launcher = Launcher(inp)
     launcher.launch(opts)
 